@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+
+import main
+
+SIZES = [1000, 10000, 100000]
+TOPICS = [
+    "one piece", "elden ring", "gta 6", "taylor swift", "nintendo switch", "landlord", "wedding", "roommate",
+    "cat", "dog", "boss", "coworker", "ai art", "steam sale", "anime season", "crunchyroll", "pokemon",
+    "minecraft", "mother in law", "boyfriend", "girlfriend", "pizza", "coffee", "gym", "tiktok", "ohio",
+    "final exam", "first date", "road trip", "halloween", "christmas", "netflix", "marvel", "star wars",
+]
+WORDS = (
+    "just finally why does everyone keep saying this is the worst best thing ever happened today my "
+    "new old friend told me about their weird plan nobody asked honestly cannot believe how people "
+    "react when you mention that update patch trailer ending season leak rumor review"
+).split()
+AUTHORS = [f"Persona_{i}" for i in range(60)]
+
+
+# Hashed bag-of-words vectors: deterministic, needs no model download, and titles sharing a topic
+# end up close together like they would with the real embedding model.
+class FakeEmbeddingModel:
+    dim = 384
+
+    def encode(self, texts, convert_to_tensor=False, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                h = zlib.crc32(word.encode('utf-8'))
+                vectors[row, h % self.dim] += 1.0
+                vectors[row, (h >> 9) % self.dim] += 0.5
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _comment_tree(rng, depth, max_depth):
+    short = rng.random() < 0.4
+    comment = {
+        "author": rng.choice(AUTHORS),
+        "comment": _sentence(rng, 2, 12) if short else "\n".join(_sentence(rng, 10, 40) for _ in range(rng.randint(1, 3))),
+        "upvotes": rng.randint(-20, 2500),
+        "replies": []
+    }
+    if depth < max_depth:
+        # Fan-out shrinks with depth, like real threads
+        for _ in range(rng.randint(0, max(0, 3 - depth))):
+            comment["replies"].append(_comment_tree(rng, depth + 1, max_depth))
+    return comment
+
+
+def make_post(rng, i):
+    topic = rng.choice(TOPICS)
+    subreddit = rng.choice(main.RSS_FEEDS).split("/r/")[1].split("/")[0]
+    return {
+        "timestamp": time.strftime("%B %d, %Y at %H:%M UTC", time.gmtime(1700000000 + i * 3600)),
+        "headline": {
+            "title": f"{_sentence(rng, 1, 4)} {topic} {_sentence(rng, 1, 6)}",
+            "body": _sentence(rng, 0, 150) if rng.random() < 0.6 else "",
+            "link": f"https://www.reddit.com/r/{subreddit}/comments/{i:x}/post_{i}/"
+        },
+        "comments": [_comment_tree(rng, 0, rng.randint(1, 5)) for _ in range(rng.randint(3, 8))]
+    }
+
+
+def make_history(n, seed=0):
+    # Newest first, the same order post_history.json used
+    rng = random.Random(seed)
+    return [make_post(rng, i) for i in reversed(range(n))]
+
+
+def consume(results):
+    # Drop each result as soon as it's produced so peak memory reflects one call, not all of them
+    for _ in results:
+        pass
+
+
+def measure(label, size, fn, setup=None):
+    # Timed run and memory run are separate, tracemalloc slows everything it traces
+    results = {}
+    for traced in (False, True):
+        state = setup() if setup else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            if traced:
+                tracemalloc.start()
+            started = time.perf_counter()
+            fn(state)
+            elapsed = time.perf_counter() - started
+            if traced:
+                results["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+            else:
+                results["seconds"] = elapsed
+    row = {"benchmark": label, "size": size, **results}
+    print(f"{label:<34} {size:>8} {row['seconds']:>10.4f}s {row['peak_mb']:>10.1f} MB")
+    return row
+
+
+def reset_state():
+    if "post_history" in main._resources:
+        main._resources["post_history"].conn.close()
+    main._resources.clear()
+    main._resources["embedding_model"] = FakeEmbeddingModel()
+    main.fragment_cache = main.FragmentCache()
+    shutil.rmtree(main.CACHE_DIR, ignore_errors=True)
+
+
+def run_size(size, seed):
+    rows = []
+    history = make_history(size, seed)
+    with open(main.HISTORY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(history, f)
+    reset_state()
+
+    def fresh_database():
+        if "post_history" in main._resources:
+            main._resources.pop("post_history").conn.close()
+        if os.path.exists(main.HISTORY_DB):
+            os.remove(main.HISTORY_DB)
+    rows.append(measure("migrate post_history.json", size, lambda _: main.get_post_history(), fresh_database))
+    store = main.get_post_history()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.get_seen_links()
+        main.get_headline_index()
+    extra_posts = make_history(50, seed + 1)
+
+    def append_posts(_):
+        for post in extra_posts:
+            main.update_post_history(post)
+    rows.append(measure("update_post_history x50", size, append_posts))
+
+    rows.append(measure("latest(MAX_POSTS_TO_DISPLAY)", size, lambda _: store.latest(main.MAX_POSTS_TO_DISPLAY)))
+
+    def rebuild_seen_links():
+        main._resources.pop("seen_links", None)
+        if os.path.exists(main.SEEN_LINKS_FILE):
+            os.remove(main.SEEN_LINKS_FILE)
+    rows.append(measure("seen-link index rebuild", size, lambda _: main.get_seen_links(), rebuild_seen_links))
+    rows.append(measure("seen-link index load", size, lambda _: main.get_seen_links(),
+                        lambda: main._resources.pop("seen_links", None)))
+    seen_links = main.get_seen_links()
+    links = [post["headline"]["link"] for post in history[:1000]]
+    rows.append(measure("seen-link lookup x1000", size, lambda _: [link in seen_links for link in links]))
+
+    def rebuild_headline_index():
+        main._resources.pop("headline_index", None)
+        for path in (main.HEADLINE_INDEX_FILE, main.HEADLINE_VECTORS_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+    rows.append(measure("headline index rebuild", size, lambda _: main.get_headline_index(), rebuild_headline_index))
+    headline_index = main.get_headline_index()
+    with contextlib.redirect_stdout(io.StringIO()):
+        queries = main._unit(main.get_embedding_store().get_embeddings([make_post(random.Random(i), i)["headline"]["title"]
+                                                                        for i in range(1000)]))
+    rows.append(measure("headline index query x1000", size, lambda _: [headline_index.nearest(v) for v in queries]))
+
+    displayed = store.latest(main.MAX_POSTS_TO_DISPLAY)
+
+    def cold_topics():
+        for name in ("embedding_store", "topic_index"):
+            main._resources.pop(name, None)
+        shutil.rmtree(main.CACHE_DIR, ignore_errors=True)
+    rows.append(measure("get_trending_topics cold", size, lambda _: main.get_trending_topics(displayed, store), cold_topics))
+    new_post = make_post(random.Random(seed + 2), size + 100)
+
+    def reload_topics():
+        for name in ("embedding_store", "topic_index"):
+            main._resources.pop(name, None)
+    rows.append(measure("get_trending_topics +1 post", size,
+                        lambda _: main.get_trending_topics([new_post] + displayed, store), reload_topics))
+
+    def cold_render():
+        main.fragment_cache = main.FragmentCache()
+        shutil.rmtree(main.FRAGMENT_CACHE_DIR, ignore_errors=True)
+    rows.append(measure("generate_feed_html cold", size, lambda _: main.generate_feed_html(displayed, store), cold_render))
+    rows.append(measure("generate_feed_html warm", size, lambda _: main.generate_feed_html(displayed, store)))
+
+    def cold_search_index():
+        shutil.rmtree(main.SEARCH_INDEX_DIR, ignore_errors=True)
+    rows.append(measure("search index build", size, lambda _: main.update_search_index(store), cold_search_index))
+    search_posts = iter(make_history(2, seed + 3))
+
+    def append_search_post():
+        store.append(next(search_posts))
+    rows.append(measure("search index +1 post", size, lambda _: main.update_search_index(store), append_search_post))
+
+    sections = [post["comments"] for post in history]
+    rows.append(measure(f"normalize_comments x{len(sections)}", size,
+                        lambda _: consume(main.normalize_comments(section) for section in sections)))
+    all_comments = [comment for section in sections for comment in main.normalize_comments(section)[0]]
+    rows.append(measure(f"format_comment x{len(all_comments)}", size,
+                        lambda _: consume(main.format_comment(comment) for comment in all_comments)))
+
+    sample = [json.dumps(post["comments"]) for post in history[:1000]]
+    truncated = [text[:int(len(text) * 0.8)] for text in sample]
+    rows.append(measure(f"repair_and_parse_json x{len(sample)}", size,
+                        lambda _: consume(main.repair_and_parse_json(text) for text in sample)))
+    rows.append(measure(f"repair_and_parse_json cut x{len(truncated)}", size,
+                        lambda _: consume(main.repair_and_parse_json(text) for text in truncated)))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory benchmarks on synthetic post history.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="History sizes to benchmark.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--write-history", metavar="PATH",
+                        help="Only write a synthetic post_history.json of the first size to PATH.")
+    args = parser.parse_args()
+
+    if args.write_history:
+        with open(args.write_history, 'w', encoding='utf-8') as f:
+            json.dump(make_history(args.sizes[0], args.seed), f, indent=2)
+        sys.exit(0)
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="clankernet-bench-")
+    os.chdir(workdir)
+    print(f"{'benchmark':<34} {'posts':>8} {'time':>11} {'peak':>13}")
+    results = []
+    try:
+        for size in args.sizes:
+            results.extend(run_size(size, args.seed))
+        reset_state()
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
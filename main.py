@@ -1,36 +1,119 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
 import yaml
 import json
-import feedparser
+import sqlite3
+import hashlib
 import random
-import google.generativeai as genai
-from google.generativeai import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup
-import time
-import requests
-from PIL import Image
+import threading
+import queue
+import signal
+import shutil
+import argparse
+import importlib
 import io
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering
+import html
+import contextlib
+import re
+from urllib.parse import urlsplit
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set!")
 MODEL_CHOICE = "gemini-2.5-flash-lite"
-CONTEXT_WINDOW = 10000
+PROMPT_TOKEN_BUDGET = 12000  # Input tokens per Gemini call, including the image
+PROMPT_TRIM_ORDER = ["post_body", "slang", "personas"]  # Sections shortened first when a prompt is over budget
+PROMPT_MIN_BODY_TOKENS = 256
+PROMPT_MIN_PERSONAS = 3
+PROMPT_TOKEN_COUNTER = "estimate"  # "estimate" (offline heuristic) or "gemini" (count_tokens API call per section)
+LLM_CACHE_MODE = "off"  # "record" saves every Gemini response to LLM_CACHE_DIR and reuses it, "replay" only answers from it
+LLM_CACHE_DIR = "llm_cache"
+STREAM_RESPONSES = True  # Parse comments while Gemini is still generating and salvage cut-off output
+IMAGE_TOKENS = 258  # What Gemini bills for an image of up to 768x768
 MAX_USERS = 10
+COMMENT_MAX_DEPTH = 10  # Reply levels kept from the model's output, deeper replies are dropped
+COMMENT_MAX_REPLIES = 30  # Comments kept per reply list and at the top level
+SHORT_COMMENT_CHARS = 80  # Comments up to this long count as short-form quips in the stats
 TEST_HEADLINE = ""
 FORCED_ENGAGEMENT = []
-HISTORY_FILE = "post_history.json"
+HISTORY_FILE = "post_history.json"  # Legacy history, migrated into HISTORY_DB on first run
+HISTORY_DB = "post_history.db"
 MAX_POSTS_TO_DISPLAY = 200
 FILTERED_USERS = ["/u/AutoModerator",  # Filters out sticky posts by these users
                   "/u/rGamesModBot",
                   "/u/AITAMod"]
 NUMBER_OF_NEW_POSTS = 1
+SERVICE_INTERVAL = 3600  # Seconds between ticks of --serve, aligned to the clock like a cron schedule
+SERVICE_POSTS_PER_TICK = NUMBER_OF_NEW_POSTS
+METRICS_DIR = "metrics"  # One JSON-lines file of stage timings and counters per run
+IMPORT_TIME_BUDGET = 0.5  # Seconds; heavy libraries are imported on first use so plain imports stay under this
+FEED_FETCH_CONCURRENCY = 8
+FEED_TIMEOUT = 10  # Seconds per feed request
+MAX_CHECKED_ENTRIES_PER_FEED = 10  # Only the most recent non-filtered entries of each feed are candidates
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_POOL_SIZE = 10  # Kept-alive connections per host, at least FEED_FETCH_CONCURRENCY
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 1  # Seconds, doubled on every retry
+HTTP_RETRY_SLEEP_BUDGET = 10  # Seconds of backoff and Retry-After sleeps per request before giving up on it
+GENERATION_CONCURRENCY = 3  # Posts generated at once; 1 runs them one after another
+BATCH_SIZE = 1  # Headlines sent to Gemini in one request, sharing the instructions and personas; 1 disables batching
+COMMENT_MAX_OUTPUT_TOKENS = 3000  # Per comment section, so a batch may use BATCH_SIZE times as many
+GEMINI_MAX_OUTPUT_TOKENS = 65536
+GEMINI_REQUESTS_PER_MINUTE = 15
+GEMINI_TOKENS_PER_MINUTE = 250000
+GEMINI_MAX_RETRIES = 5
+GEMINI_BACKOFF_BASE = 2  # Seconds, doubled on every retry
+GEMINI_BACKOFF_MAX = 60
+EMBEDDING_BACKEND = "sentence-transformers"  # or "hashing": no model download or torch, starts instantly, works offline
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_THREADS = 0  # Torch CPU threads used for encoding, 0 keeps torch's default
+HASHING_EMBEDDING_DIM = 384  # Same width as all-MiniLM-L6-v2, so the caches cost the same either way
+CACHE_DIR = "cache"
+EMBEDDING_MATRIX_FILE = os.path.join(CACHE_DIR, "embeddings.f32")
+EMBEDDING_INDEX_FILE = os.path.join(CACHE_DIR, "embeddings_index.json")
+SEEN_LINKS_FILE = os.path.join(CACHE_DIR, "seen_links.npz")
+CANDIDATE_QUEUE_DB = os.path.join(CACHE_DIR, "candidates.db")
+CANDIDATE_MAX_AGE = 24 * 3600  # Seconds a harvested headline stays eligible for posting
+CANDIDATE_MAX_PER_SUBREDDIT = 50  # Oldest queued headlines of a subreddit are dropped beyond this
+FRAGMENT_CACHE_DIR = os.path.join(CACHE_DIR, "fragments")
+FRAGMENT_CACHE_VERSION = 2  # Bump whenever the post markup changes
+PERSONAS_FILE = "personas.yml"
+PERSONA_CACHE_FILE = os.path.join(CACHE_DIR, "personas.json")
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+IMAGE_MAX_BYTES = 8 * 1024 * 1024  # Downloads larger than this are abandoned
+IMAGE_TIMEOUT = 10
+IMAGE_THUMBNAIL_SIZE = (768, 768)
+IMAGE_CONTENT_TYPES = ("image/jpeg", "image/png", "image/webp")
+OUTPUT_DIR = "."  # index.html, page-N.html, CLIENT_DATA_DIR and SEARCH_INDEX_DIR are written here
+POSTS_PER_PAGE = 0  # 0 keeps every displayed post in index.html, otherwise split into page-2.html, page-3.html, ...
+RENDER_MODE = "static"  # "static" pre-renders every post, "client" writes a small index.html that renders CLIENT_DATA_DIR in the browser
+CLIENT_DATA_DIR = "data"
+CLIENT_PAGE_POSTS = 20  # Post summaries per CLIENT_DATA_DIR/pages/<n>.json, fetched as the reader scrolls
+SEARCH_INDEX_DIR = "search"  # Static full-text index over the whole history, queried by the page; "" disables it
+SEARCH_INDEX_VERSION = 1  # Bump whenever the index format or tokenization changes, the index is rebuilt
+SEARCH_DOCS_PER_FILE = 1000
+SEARCH_MIN_TERM_LENGTH = 2
+SEARCH_MAX_TERM_LENGTH = 40
+SEARCH_FIELD_WEIGHTS = {"title": 4, "body": 2, "comment": 1, "author": 1}
+SEARCH_STOP_WORDS = frozenset((
+    "a an and are as at be but by for from has have he her his i if in is it its me my no not of on or our "
+    "she so that the their them they this to was we were what when which who will with you your"
+).split())
+TOPIC_STATE_FILE = os.path.join(CACHE_DIR, "topics.json")
+TOPIC_CENTROIDS_FILE = os.path.join(CACHE_DIR, "topic_centroids.npz")
+CLUSTER_DISTANCE_THRESHOLD = 1.5
+TOPIC_ASSIGN_SIMILARITY = 0.5  # Minimum cosine similarity to a topic centroid to join it between re-clusterings
+RECLUSTER_INTERVAL = 50  # New headlines between bounded re-clusterings
+RECLUSTER_WINDOW = 2000  # Most recent headlines included in a re-clustering
+HEADLINE_VECTORS_FILE = os.path.join(CACHE_DIR, "headline_vectors.f32")
+HEADLINE_INDEX_FILE = os.path.join(CACHE_DIR, "headline_index.npz")
+DUPLICATE_SIMILARITY = 0.9  # Candidates at least this similar to a posted headline are skipped as reposts; above 1 disables
+HEADLINE_INDEX_EXACT_LIMIT = 5000  # Below this many headlines every one is compared, above it only the probed groups
+HEADLINE_INDEX_PROBES = 8
+HEADLINE_INDEX_TAIL_LIMIT = 1000  # Unsorted new headlines scanned in full before they are sorted into their groups
 
 RSS_FEEDS = [
     "https://www.reddit.com/r/animenews/.rss",
@@ -205,19 +288,811 @@ YOUTH_SLANG = {
 SLANG_NUM = 20
 
 # Choose slang
-keys = list(YOUTH_SLANG.keys())
-keys_to_keep = random.sample(keys, SLANG_NUM)
-YOUTH_SLANG = {key: YOUTH_SLANG[key] for key in keys_to_keep}
-print(f"Using slang: {keys_to_keep}")
+ALL_YOUTH_SLANG = YOUTH_SLANG
+
+
+def choose_slang():
+    keys_to_keep = random.sample(list(ALL_YOUTH_SLANG.keys()), SLANG_NUM)
+    print(f"Using slang: {keys_to_keep}")
+    return {key: ALL_YOUTH_SLANG[key] for key in keys_to_keep}
+
+
+YOUTH_SLANG = choose_slang()
+
+
+PROMPT_INTRO = (
+    "You are an API that generates a simulated Reddit comment section for a given headline. "
+    "Your final output must be a single, valid JSON object and nothing else. Do not include any explanatory text before or after the JSON. "
+    "The JSON object should be a list of top-level comment objects, each with 'author', 'comment', 'upvotes', and 'replies' keys. The 'replies' key contains a list of nested comment objects.\n\n"
+)
+PROMPT_SHORT_FORM_NOTE = (
+    "Remember, any persona can make a short comment. An 'Expert Analyst' isn't limited to long paragraphs; they can also make a cutting, one-phrase joke or observation.\n"
+)
+PROMPT_BATCH_INTRO = (
+    "You are an API that generates simulated Reddit comment sections for several headlines at once. "
+    "Your final output must be a single, valid JSON object and nothing else. Do not include any explanatory text before or after the JSON. "
+    "The JSON object must have one key per post id given below (for example \"post_1\"). Each value is that post's comment section: a list of top-level comment objects, each with 'author', 'comment', 'upvotes', and 'replies' keys. The 'replies' key contains a list of nested comment objects.\n\n"
+)
+PROMPT_INSTRUCTIONS = (
+    "CRITICAL INSTRUCTIONS & EXAMPLES \n"
+    "You must follow TWO primary rules to create a realistic comment section:\n\n"
+    "RULE 1: The Rule of Balance (CRITICAL: MINIMUM 40% SHORT-FORM). To ensure realistic variety, you MUST adhere to a specific mix. At least 40% of the total comments (including replies) MUST be 'short-form.' A short-form comment is strictly defined as UNDER 15 WORDS, often a single sentence, phrase, emoji-laden response, or even just a few words. These are the memes, the one-line zingers, quick reactions, and gut feelings. This balance is not optional.\n\n"
+    "RULE 2: The Rule of Conversation. The primary goal is to simulate a conversation, not a list of disconnected statements. Therefore, you MUST create deep comment threads. At least 50% of the personas used MUST reply to another comment rather than creating a new top-level comment. A flat list of many top-level comments with no replies is a FAILED generation.\n\n"
+    "All comments, regardless of length or depth, must demonstrate specific knowledge. They must talk as if they are true fans, critics, or experts who are deeply familiar with the subject. For very short comments, this 'knowledge' can be conveyed through specific slang, inside jokes, character/lore nicknames, or an informed, immediate emotional reaction that only a true fan would have. The persona's traits should COLOR their commentary, not REPLACE it.\n\n"
+    "--- EXAMPLES OF GOOD COMMENT *CONTENT* ---\n"
+    "For example, if the headline is 'One Punch Man Season 3: 6.5 Years Wait for Same Recycled Animation':\n\n"
+    "GOOD (Detailed): \"author\": \"Prodigy_von_Ordelia\", \"comment\": \"Six and a half years for this? After the disaster of J.C. Staff's handling of S2, particularly the metal shine on Genos and the slideshow-level Garou fight, I expected a complete overhaul. To hear it's 'recycled animation' suggests they learned nothing. Unacceptable.\"\n"
+    "GOOD (Short & Knowledgeable): \"author\": \"ChadThunderclap\", \"comment\": \"JC Staff and their damn metal shine, name a more iconic duo. I'll wait.\"\n"
+    "BAD (Generic): \"author\": \"Prodigy_von_Ordelia\", \"comment\": \"A 6.5-year delay is unacceptable. Studios need to be held to a higher standard.\"\n\n"
+    "--- EXAMPLE OF GOOD COMMENT *STRUCTURE* (Following the Rule of Conversation) ---\n"
+    "This shows how personas should reply to each other in a nested thread:\n"
+    "```json\n"
+    "[\n"
+    '  {\n'
+    '    "author": "PixelProwler",\n'
+    '    "comment": "OMG, the particle effects on the sword are insane.",\n'
+    '    "upvotes": 128,\n'
+    '    "replies": [\n'
+    '      {\n'
+    '        "author": "Prodigy_von_Ordelia",\n'
+    '        "comment": "Incredible? The design is derivative of every dark fantasy trope from the last decade. The armor is impractical and the particle effects will just obscure the telegraphing for his attacks. It\'s style over substance.",\n'
+    '        "upvotes": 45,\n'
+    '        "replies": [\n'
+    '          {\n'
+    '            "author": "ChadThunderclap",\n'
+    '            "comment": "lol nerd. Big sword go brrrr.",\n'
+    '            "upvotes": 250,\n'
+    '            "replies": []\n'
+    '          }\n'
+    '        ]\n'
+    '      }\n'
+    '    ]\n'
+    '  }\n'
+    ']\n'
+    "```\n"
+    "END OF CRITICAL INSTRUCTIONS \n\n"
+    "FINAL CHECKLIST BEFORE GENERATING \n"
+    "- Conversational Depth: Does the output feel like a conversation? Are there multiple deep comment threads (2+ replies deep)? Did I follow the Rule of Conversation, ensuring at least half the personas are replying?\n"
+    "- Comment Length Variety: Is there a healthy mix of long and short comments? Did I meet the 40% short-form rule (UNDER 15 WORDS)?\n"
+    "- Knowledge Depth: Do even the shortest comments contain a specific reference, nickname, or piece of in-community knowledge?\n"
+    "- Overall Vibe: Does this feel like a real, chaotic, and diverse fan forum, not just a collection of essays?\n\n"
+    "Now, generate a full, nested comment section for the provided headline. Remember:\n"
+    "- The diction should be reflective of modern brain rotted online communities heavily favoring short, fragmented sentences, single-phrase quips, slang, and emojis for many comments,** alongside longer, more detailed discussions.\n"
+    "- Do not use markdown formatting in the final comment text.\n"
+    "- Comment length should vary from short single phrase quips to multi-paragraph rants.\n"
+    "- Do not simulate replies from the original post author. Only use the provided fictional personas.\n"
+    "- The PRIMARY GOAL is to create conversation threads where personas react and reply to one another. A long list of un-replied, top-level comments is a failure.\n"
+    "- Ensure the final output is only the JSON object."
+)
+PROMPT_BATCH_NOTE = (
+    "\n\nThis request contains several posts. Everything above applies to each post's comment section separately: "
+    "every section follows both rules and only reacts to its own headline, body and image. "
+    "Return every post id as a key of the JSON object, each holding its own list of comments."
+)
+
+# Heavy libraries, models and clients are only loaded the first time something needs them, so runs
+# that only render or never find a headline don't pay for them.
+_resources = {}
+_resources_lock = threading.RLock()
+
+
+def _resource(name, factory):
+    with _resources_lock:
+        if name not in _resources:
+            _resources[name] = factory()
+        return _resources[name]
+
+
+def _import(module_name):
+    # Goes through the resource lock so worker threads never race each other importing the same package
+    return _resource(module_name, lambda: importlib.import_module(module_name))
+
+
+# Both backends turn a list of titles into one unit-length float32 row per title
+class SentenceTransformerBackend:
+    def __init__(self, model_name, batch_size, threads):
+        self.batch_size = batch_size
+        if threads:
+            _import("torch").set_num_threads(threads)
+        SentenceTransformer = _import("sentence_transformers").SentenceTransformer
+        print(f"--- Loading embedding model {model_name} ---")
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts):
+        return self.model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+
+# Signed feature hashing of word uni/bigrams plus character 3-5 grams straight into a dense vector.
+# Nothing is fitted, so a title always gets the same vector and the cached ones stay valid run to run.
+class HashingBackend:
+    def __init__(self, dim):
+        HashingVectorizer = _import("sklearn.feature_extraction.text").HashingVectorizer
+        self.words = HashingVectorizer(n_features=dim, ngram_range=(1, 2))
+        self.chars = HashingVectorizer(n_features=dim, analyzer='char_wb', ngram_range=(3, 5))
+
+    def encode(self, texts):
+        texts = list(texts)
+        vectors = (self.words.transform(texts) + self.chars.transform(texts)).toarray().astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+EMBEDDING_BACKENDS = {
+    "sentence-transformers": lambda: SentenceTransformerBackend(EMBEDDING_MODEL_NAME, EMBEDDING_BATCH_SIZE, EMBEDDING_THREADS),
+    "hashing": lambda: HashingBackend(HASHING_EMBEDDING_DIM),
+}
 
-# Load the sentence transformer model once at the start of the script
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+
+def embedding_model_name():
+    # Identifies the vector space without loading the backend; the embedding, topic and headline caches
+    # are rebuilt whenever it changes
+    return EMBEDDING_MODEL_NAME if EMBEDDING_BACKEND == "sentence-transformers" else f"hashing-{HASHING_EMBEDDING_DIM}"
+
+
+def get_embedding_model():
+    return _resource("embedding_model", lambda: EMBEDDING_BACKENDS[EMBEDDING_BACKEND]())
+
+
+def get_http_session():
+    # One pooled session for feeds and images; they all go to the same handful of Reddit hosts
+    def load():
+        requests = _import("requests")
+        Retry = _import("urllib3.util.retry").Retry
+
+        # The sleeps of all retries of a request share HTTP_RETRY_SLEEP_BUDGET, so a rate-limited feed is
+        # given up on for this run after a few seconds instead of holding the job for minutes
+        class CappedRetry(Retry):
+            def __init__(self, *args, slept=0.0, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.slept = slept
+
+            def new(self, **kwargs):
+                kwargs.setdefault("slept", self.slept)
+                return super().new(**kwargs)
+
+            def is_exhausted(self):
+                return super().is_exhausted() or self.slept >= HTTP_RETRY_SLEEP_BUDGET
+
+            def sleep(self, response=None):
+                delay = self.get_retry_after(response) if response is not None and self.respect_retry_after_header else None
+                if delay is None:
+                    delay = self.get_backoff_time()
+                delay = max(0.0, min(delay, HTTP_RETRY_SLEEP_BUDGET - self.slept))
+                self.slept += delay
+                if delay:
+                    time.sleep(delay)
+
+        retries = CappedRetry(total=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                              status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET", "HEAD"),
+                              respect_retry_after_header=True, raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                                max_retries=retries)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _resource("http_session", load)
+
+
+def http_get(url, read_timeout, **kwargs):
+    return get_http_session().get(url, timeout=(HTTP_CONNECT_TIMEOUT, read_timeout), **kwargs)
+
+
+def get_client():
+    def load():
+        genai = _import("google.generativeai")
+        api_key = os.environ.get('GEMINI_API_KEY')
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY environment variable not set!")
+        genai.configure(api_key=api_key)
+        return genai.GenerativeModel(MODEL_CHOICE)
+    return _resource("client", load)
+
+
+def title_hash(title):
+    return hashlib.sha1(title.encode('utf-8')).hexdigest()
+
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def save_npz_atomic(path, **arrays):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def append_vectors(path, rows, dim, vectors):
+    # Appends float32 rows to a flat file that should hold `rows` of them; anything past that was written
+    # by a crashed run that never got to save its index, and is dropped first
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    mode = 'r+b' if rows and os.path.exists(path) else 'wb'
+    with open(path, mode) as f:
+        f.seek(rows * dim * 4)
+        f.truncate()
+        f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+
+# Wall time per pipeline stage plus named counters, shared by every thread. Each finished stage is also
+# kept as an event for the run's JSON-lines file. Stages listed in profile_stages run under cProfile
+# and ones in trace_stages under tracemalloc; only one stage is profiled at a time, so concurrent
+# calls of the same stage are timed but not profiled.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+        self.profile_stages = set()
+        self.trace_stages = set()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.events = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiled = (name in self.profile_stages or name in self.trace_stages) and self.profile_lock.acquire(blocking=False)
+        profiler = None
+        if profiled and name in self.profile_stages:
+            profiler = _import("cProfile").Profile()
+            profiler.enable()
+        if profiled and name in self.trace_stages:
+            _import("tracemalloc").start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiled:
+                try:
+                    self._report_profile(name, profiler)
+                finally:
+                    self.profile_lock.release()
+            with self.lock:
+                stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+                stats["calls"] += 1
+                stats["seconds"] += elapsed
+                stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+                self.events.append({"stage": name, "seconds": round(elapsed, 6), "at": round(time.time(), 3)})
+
+    def _report_profile(self, name, profiler):
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"{int(self.started)}-{name}.prof")
+            profiler.dump_stats(path)
+            print(f"\n--- cProfile of stage '{name}' (full stats in {path}) ---")
+            _import("pstats").Stats(profiler).sort_stats("cumulative").print_stats(15)
+        tracemalloc = _import("tracemalloc")
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"\n--- tracemalloc of stage '{name}': peak {peak / 2 ** 20:.1f} MB, top allocations ---")
+            for stat in snapshot.statistics("lineno")[:10]:
+                print(stat)
+
+    def write(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, datetime.fromtimestamp(self.started, timezone.utc).strftime("%Y%m%d-%H%M%S") + ".jsonl")
+        with self.lock, open(path, 'w', encoding='utf-8') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+            f.write(json.dumps({"summary": True, "started": round(self.started, 3),
+                                "seconds": round(time.time() - self.started, 3),
+                                "stages": self.stages, "counters": self.counters}) + "\n")
+        return path
+
+    def summary(self):
+        with self.lock:
+            lines = [f"{'stage':<22} {'calls':>6} {'total':>10} {'mean':>10} {'max':>10}"]
+            for name, stats in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+                lines.append(f"{name:<22} {stats['calls']:>6} {stats['seconds']:>9.3f}s "
+                             f"{stats['seconds'] / stats['calls']:>9.3f}s {stats['max_seconds']:>9.3f}s")
+            if self.counters:
+                lines.append("")
+                lines.extend(f"{name:<29} {value:>10}" for name, value in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+# Headline vectors are stored once in a flat float32 file (memory-mapped on read) with a
+# title hash -> row index next to it, so each run only has to encode the titles it hasn't seen.
+class EmbeddingStore:
+    def __init__(self, load_model, model_name, matrix_path=EMBEDDING_MATRIX_FILE, index_path=EMBEDDING_INDEX_FILE):
+        self.load_model = load_model
+        self.model_name = model_name
+        self.matrix_path = matrix_path
+        self.index_path = index_path
+        self.rows = {}
+        self.dim = None
+        self._matrix = None
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = None
+
+        if not index:
+            return
+        if index.get('model') != self.model_name:
+            print(f"--- Embedding cache was built with {index.get('model')}, rebuilding for {self.model_name} ---")
+            return
+
+        rows, dim = index.get('rows', {}), index.get('dim')
+        try:
+            matrix_size = os.path.getsize(self.matrix_path)
+        except OSError:
+            matrix_size = 0
+        if rows and (not dim or matrix_size < len(rows) * dim * 4):
+            print("--- Embedding cache is incomplete, rebuilding ---")
+            return
+
+        self.rows = rows
+        self.dim = dim
+
+    def _matrix_view(self):
+        if self._matrix is None or len(self._matrix) != len(self.rows):
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(len(self.rows), self.dim))
+        return self._matrix
+
+    def _append(self, hashes, vectors):
+        if not self.rows:
+            self.dim = np.shape(vectors)[1]
+        append_vectors(self.matrix_path, len(self.rows), self.dim, vectors)
+        for h in hashes:
+            self.rows[h] = len(self.rows)
+        self._matrix = None
+        write_json_atomic(self.index_path, {"model": self.model_name, "dim": self.dim, "rows": self.rows})
+
+    def get_embeddings(self, titles):
+        hashes = [title_hash(title) for title in titles]
+        # Concurrent generations look up headlines at pop time, and appends must not interleave
+        with self.lock:
+            missing = {}
+            for h, title in zip(hashes, titles):
+                if h not in self.rows and h not in missing:
+                    missing[h] = title
+
+            if missing:
+                print(f"--- Encoding {len(missing)} new headlines ({len(self.rows)} cached) ---")
+                with metrics.stage("embedding"):
+                    vectors = self.load_model().encode(list(missing.values()))
+                metrics.count("headlines_encoded", len(missing))
+                self._append(list(missing.keys()), vectors)
+
+            if not hashes:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            return np.asarray(self._matrix_view()[[self.rows[h] for h in hashes]])
+
+
+def get_embedding_store():
+    return _resource("embedding_store", lambda: EmbeddingStore(get_embedding_model, embedding_model_name()))
+
+
+def _cosine(a, b):
+    return float(np.dot(a, b) / ((np.linalg.norm(a) * np.linalg.norm(b)) or 1.0))
+
+
+# Online leader clustering: each new headline joins the most similar topic centroid if it is at least
+# TOPIC_ASSIGN_SIMILARITY, otherwise it starts a new topic. Every
+# RECLUSTER_INTERVAL headlines the RECLUSTER_WINDOW most recent ones are re-clustered with
+# AgglomerativeClustering and matched back onto the existing topic ids, so ids stay stable.
+class TopicIndex:
+    def __init__(self, store, model_name, state_path=TOPIC_STATE_FILE, centroids_path=TOPIC_CENTROIDS_FILE):
+        self.store = store
+        self.model_name = model_name
+        self.state_path = state_path
+        self.centroids_path = centroids_path
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        self.next_id = 0
+        self.since_recluster = 0
+        self.assignments = {}  # title hash -> topic id
+        self.recent = []  # titles in assignment order, capped at RECLUSTER_WINDOW
+        self.names = {}  # topic id -> most representative title
+        self.ids = []
+        self.row_of = {}
+        self.sums = np.zeros((0, 0), dtype=np.float32)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if state.get('model') != self.model_name:
+            print(f"--- Topic state was built with {state.get('model')}, rebuilding for {self.model_name} ---")
+            return
+        try:
+            with np.load(self.centroids_path) as arrays:
+                ids, sums, counts = arrays['ids'].tolist(), arrays['sums'], arrays['counts']
+        except (OSError, KeyError, ValueError):
+            print("--- Topic centroids are missing, rebuilding topics ---")
+            return
+
+        self.next_id = state['next_id']
+        self.since_recluster = state['since_recluster']
+        self.assignments = state['assignments']
+        self.recent = state['recent']
+        self.names = {int(topic_id): name for topic_id, name in state['names'].items()}
+        self.ids = ids
+        self.row_of = {topic_id: row for row, topic_id in enumerate(ids)}
+        self.sums = sums.astype(np.float32)
+        self.counts = counts.astype(np.int64)
+
+    def save(self):
+        live = [row for row in range(len(self.ids)) if self.counts[row] > 0]
+        self.ids = [self.ids[row] for row in live]
+        self.row_of = {topic_id: row for row, topic_id in enumerate(self.ids)}
+        self.sums = self.sums[live]
+        self.counts = self.counts[live]
+        self.names = {topic_id: name for topic_id, name in self.names.items() if topic_id in self.row_of}
+
+        save_npz_atomic(self.centroids_path, ids=np.array(self.ids, dtype=np.int64), sums=self.sums, counts=self.counts)
+        write_json_atomic(self.state_path, {
+            "model": self.model_name,
+            "next_id": self.next_id,
+            "since_recluster": self.since_recluster,
+            "assignments": self.assignments,
+            "recent": self.recent,
+            "names": self.names
+        })
+
+    def _new_topic(self, dim):
+        if len(self.ids) == len(self.sums):
+            capacity = max(16, 2 * len(self.sums))
+            sums = np.zeros((capacity, dim), dtype=np.float32)
+            counts = np.zeros(capacity, dtype=np.int64)
+            if len(self.ids):
+                sums[:len(self.ids)] = self.sums
+                counts[:len(self.ids)] = self.counts
+            self.sums, self.counts = sums, counts
+        topic_id = self.next_id
+        self.next_id += 1
+        self.row_of[topic_id] = len(self.ids)
+        self.ids.append(topic_id)
+        return topic_id
+
+    def _nearest_topic(self, vector):
+        n = len(self.ids)
+        if n == 0:
+            return None
+        sums = self.sums[:n]
+        norms = np.linalg.norm(sums, axis=1) * (np.linalg.norm(vector) or 1.0)
+        similarities = (sums @ vector) / np.where(norms > 0, norms, 1.0)
+        similarities[self.counts[:n] == 0] = -np.inf
+        best = int(np.argmax(similarities))
+        return self.ids[best] if similarities[best] >= TOPIC_ASSIGN_SIMILARITY else None
+
+    def _move(self, topic_id, vector, sign):
+        row = self.row_of[topic_id]
+        self.sums[row] += sign * vector
+        self.counts[row] += sign
+
+    def _centroid(self, topic_id):
+        row = self.row_of[topic_id]
+        return self.sums[row] / max(self.counts[row], 1)
+
+    def _pick_name(self, topic_id, candidates):
+        # candidates: (title, vector) pairs; keep the current name in the running if still a member
+        current = self.names.get(topic_id)
+        if current is not None and self.assignments.get(title_hash(current)) == topic_id:
+            candidates = candidates + [(current, self.store.get_embeddings([current])[0])]
+        if not candidates:
+            # Only members outside the re-cluster window are left; the old name still describes them
+            if self.counts[self.row_of[topic_id]] == 0:
+                self.names.pop(topic_id, None)
+            return
+        centroid = self._centroid(topic_id)
+        self.names[topic_id] = max(candidates, key=lambda c: _cosine(c[1], centroid))[0]
+
+    def assign(self, titles):
+        hashes = [title_hash(title) for title in titles]
+        new = {}
+        for h, title in zip(hashes, titles):
+            if h not in self.assignments and h not in new:
+                new[h] = title
+
+        if new:
+            vectors = self.store.get_embeddings(list(new.values()))
+            for (h, title), vector in zip(new.items(), vectors):
+                topic_id = self._nearest_topic(vector)
+                if topic_id is None:
+                    topic_id = self._new_topic(len(vector))
+                self._move(topic_id, vector, 1)
+                self.assignments[h] = topic_id
+                self._pick_name(topic_id, [(title, vector)])
+            self.recent = (self.recent + list(new.values()))[-RECLUSTER_WINDOW:]
+            self.since_recluster += len(new)
+            print(f"--- Assigned {len(new)} new headlines to {len(self.ids)} topics ---")
+
+            if self.since_recluster >= RECLUSTER_INTERVAL:
+                self.recluster()
+            self.save()
+
+        return [self.assignments[h] for h in hashes]
+
+    def recluster(self):
+        self.since_recluster = 0
+        titles = self.recent
+        if len(titles) < 2:
+            return
+        print(f"--- Re-clustering the {len(titles)} most recent headlines ---")
+        vectors = self.store.get_embeddings(titles)
+        hashes = [title_hash(title) for title in titles]
+        AgglomerativeClustering = _import("sklearn.cluster").AgglomerativeClustering
+        clustering = AgglomerativeClustering(n_clusters=None, distance_threshold=CLUSTER_DISTANCE_THRESHOLD)
+        with metrics.stage("recluster"):
+            labels = clustering.fit(vectors).labels_
+
+        # Hand each new cluster the existing topic id it overlaps most, largest overlaps first
+        overlap = {}
+        for label, h in zip(labels, hashes):
+            key = (label, self.assignments[h])
+            overlap[key] = overlap.get(key, 0) + 1
+        label_to_topic = {}
+        claimed = set()
+        for (label, topic_id), _ in sorted(overlap.items(), key=lambda item: item[1], reverse=True):
+            if label not in label_to_topic and topic_id not in claimed:
+                label_to_topic[label] = topic_id
+                claimed.add(topic_id)
+
+        touched = set()
+        for h, vector, label in zip(hashes, vectors, labels):
+            if label not in label_to_topic:
+                label_to_topic[label] = self._new_topic(len(vector))
+            old_topic, new_topic = self.assignments[h], label_to_topic[label]
+            if old_topic != new_topic:
+                self._move(old_topic, vector, -1)
+                self._move(new_topic, vector, 1)
+                self.assignments[h] = new_topic
+                touched.update((old_topic, new_topic))
+
+        for topic_id in touched:
+            members = [(title, vector) for title, h, vector in zip(titles, hashes, vectors)
+                       if self.assignments[h] == topic_id]
+            self._pick_name(topic_id, members)
+
+    def trending(self):
+        topics = []
+        for row, topic_id in enumerate(self.ids):
+            if self.counts[row] > 1:
+                topics.append({"name": self.names[topic_id], "count": int(self.counts[row]), "id": topic_id})
+        return topics
+
+
+def get_topic_index():
+    return _resource("topic_index", lambda: TopicIndex(get_embedding_store(), embedding_model_name(), TOPIC_STATE_FILE,
+                                                           TOPIC_CENTROIDS_FILE))
+
+
+def _unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+# Nearest-neighbour index over the embeddings of every posted headline, so crossposts and reworded
+# reposts are caught before they cost a Gemini call. Unit vectors live in a flat float32 file that is
+# memory-mapped for queries. Past HEADLINE_INDEX_EXACT_LIMIT headlines the file is kept sorted into
+# spherical k-means groups (an inverted file), so a query reads only the HEADLINE_INDEX_PROBES groups
+# whose centroids are closest, as contiguous slices, plus the unsorted tail of headlines added since.
+# The tail is sorted in once it passes HEADLINE_INDEX_TAIL_LIMIT, and the centroids are retrained
+# whenever the history has doubled since they were last trained.
+class HeadlineIndex:
+    def __init__(self, store, history, model_name, vectors_path=HEADLINE_VECTORS_FILE, index_path=HEADLINE_INDEX_FILE):
+        self.store = store
+        self.history = history
+        self.model_name = model_name
+        self.vectors_path = vectors_path
+        self.index_path = index_path
+        self.count = 0  # posts covered, some may have had no title
+        self.rows = 0
+        self.dim = None
+        self.trained = 0
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)  # group g is rows offsets[g]:offsets[g + 1], the tail starts at offsets[-1]
+        self._matrix = None
+        self._load()
+        if self.count != len(history):
+            self.rebuild()
+
+    def _load(self):
+        try:
+            with np.load(self.index_path) as arrays:
+                model = str(arrays['model'])
+                count, rows, dim, trained = (int(arrays[name]) for name in ('count', 'rows', 'dim', 'trained'))
+                centroids, offsets = arrays['centroids'], arrays['offsets']
+        except (OSError, KeyError, ValueError):
+            return
+        if model != self.model_name:
+            print(f"--- Headline index was built with {model}, rebuilding for {self.model_name} ---")
+            return
+        try:
+            vectors_size = os.path.getsize(self.vectors_path)
+        except OSError:
+            vectors_size = 0
+        if vectors_size < rows * dim * 4:
+            return
+
+        self.count, self.rows, self.dim, self.trained = count, rows, dim or None, trained
+        self.centroids, self.offsets = centroids, offsets
+
+    def save(self):
+        save_npz_atomic(self.index_path, model=np.str_(self.model_name), count=np.int64(self.count),
+                        rows=np.int64(self.rows), dim=np.int64(self.dim or 0), trained=np.int64(self.trained),
+                        centroids=self.centroids, offsets=self.offsets)
+
+    def _vectors(self):
+        if self._matrix is None or len(self._matrix) != self.rows:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.rows, self.dim))
+        return self._matrix
+
+    def _append(self, vectors):
+        append_vectors(self.vectors_path, self.rows, self.dim, vectors)
+        self.rows += len(vectors)
+        self._matrix = None
+
+    def rebuild(self):
+        titles = list(self.history.titles())
+        self.count = len(self.history)
+        self.rows = 0
+        self.trained = 0
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        if titles:
+            vectors = _unit(self.store.get_embeddings(titles))
+            self.dim = vectors.shape[1]
+            self._append(vectors)
+        if self.rows >= HEADLINE_INDEX_EXACT_LIMIT:
+            self._train()
+        self.save()
+        print(f"--- Rebuilt headline index with {self.rows} headlines ---")
+
+    def _train(self):
+        vectors = self._vectors()
+        rng = np.random.default_rng(0)
+        groups = int(np.sqrt(self.rows))
+        sample = np.asarray(vectors[np.sort(rng.choice(self.rows, min(self.rows, 64 * groups), replace=False))])
+        centroids = sample[rng.choice(len(sample), groups, replace=False)]
+        for _ in range(10):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # A centroid that attracted nothing keeps its old position
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1.0), centroids)
+        self.centroids = centroids.astype(np.float32)
+        self.trained = self.rows
+        self._sort()
+
+    def _sort(self):
+        # Rewrite the vector file grouped by nearest centroid, tail included
+        vectors = self._vectors()
+        labels = np.concatenate([np.argmax(np.asarray(vectors[start:start + 20000]) @ self.centroids.T, axis=1)
+                                 for start in range(0, self.rows, 20000)])
+        order = np.argsort(labels, kind='stable')
+        tmp_path = self.vectors_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            for start in range(0, self.rows, 20000):
+                f.write(np.ascontiguousarray(vectors[order[start:start + 20000]]).tobytes())
+        self._matrix = None
+        os.replace(tmp_path, self.vectors_path)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(self.centroids))))).astype(np.int64)
+
+    def add(self, title):
+        self.count += 1
+        if title:
+            vector = _unit(self.store.get_embeddings([title]))
+            self.dim = self.dim or vector.shape[1]
+            self._append(vector)
+            if self.rows >= max(HEADLINE_INDEX_EXACT_LIMIT, 2 * self.trained):
+                self._train()
+            elif len(self.centroids) and self.rows - self.offsets[-1] > HEADLINE_INDEX_TAIL_LIMIT:
+                self._sort()
+        self.save()
+
+    def nearest(self, vector):
+        # Cosine similarity of the closest posted headline to a unit vector
+        if not self.rows:
+            return 0.0
+        vectors = self._vectors()
+        tail = int(self.offsets[-1])
+        best = float(np.max(vectors[tail:] @ vector)) if tail < self.rows else 0.0
+        if len(self.centroids):
+            closest = self.centroids @ vector
+            for group in np.argpartition(-closest, min(HEADLINE_INDEX_PROBES, len(closest)) - 1)[:HEADLINE_INDEX_PROBES]:
+                start, end = self.offsets[group], self.offsets[group + 1]
+                if start < end:
+                    best = max(best, float(np.max(vectors[start:end] @ vector)))
+        return best
+
+
+def get_headline_index():
+    return _resource("headline_index",
+                     lambda: HeadlineIndex(get_embedding_store(), get_post_history(), embedding_model_name(),
+                                           HEADLINE_VECTORS_FILE, HEADLINE_INDEX_FILE))
+
+
+# A persona dict that carries its own compact JSON, serialized once when personas.yml is parsed
+class Persona(dict):
+    __slots__ = ("fragment",)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.fragment = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+# Parsed personas.yml, kept in memory while the file's mtime is unchanged and on disk as JSON keyed
+# by the file's hash, so the YAML is only parsed again after the file has actually been edited.
+class PersonaLibrary:
+    def __init__(self, path=PERSONAS_FILE, cache_path=PERSONA_CACHE_FILE):
+        self.path = path
+        self.cache_path = cache_path
+        self.mtime = None
+        self.digest = None
+        self.personas = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.path, 'rb') as f:
+                    raw = f.read()
+                digest = hashlib.sha1(raw).hexdigest()
+                if digest != self.digest:
+                    self.personas = [Persona(p) for p in self._parse(raw, digest)]
+                    self.digest = digest
+                self.mtime = mtime
+            return list(self.personas)
+
+    def _parse(self, raw, digest):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get("sha1") == digest:
+                return cached["personas"]
+        except (FileNotFoundError, ValueError, KeyError, AttributeError):
+            pass
+
+        # The libyaml loader is many times faster than the pure Python one when PyYAML was built with it
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        personas = yaml.load(raw.decode('utf-8'), Loader=loader) or []
+        write_json_atomic(self.cache_path, {"sha1": digest, "personas": personas})
+        return personas
+
+
+def get_persona_library():
+    return _resource("persona_library", PersonaLibrary)
 
 
 def load_personas():
     try:
-        with open("personas.yml", 'r', encoding='utf-8') as ymlfile:
-            personas = yaml.safe_load(ymlfile)
+        personas = get_persona_library().load()
     except FileNotFoundError:
         print("No personas.yml found")
         personas = []
@@ -252,104 +1127,848 @@ def load_personas():
     return personas
 
 
-genai.configure(api_key=GEMINI_API_KEY)
-client = genai.GenerativeModel(MODEL_CHOICE)
+# Token bucket shared by every thread that talks to Gemini, limiting both requests and input tokens per minute
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = (float(requests_per_minute), float(tokens_per_minute))
+        self.levels = list(self.capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        needed = (1.0, min(float(tokens), self.capacity[1]))
+        while True:
+            with self.lock:
+                now = self.clock()
+                for i, capacity in enumerate(self.capacity):
+                    self.levels[i] = min(capacity, self.levels[i] + (now - self.updated) * capacity / 60)
+                self.updated = now
+                if all(level >= need for level, need in zip(self.levels, needed)):
+                    self.levels = [level - need for level, need in zip(self.levels, needed)]
+                    return
+                wait = max((need - level) * 60 / capacity
+                           for level, need, capacity in zip(self.levels, needed, self.capacity))
+            self.sleep(wait)
+
+
+rate_limiter = RateLimiter(GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+
+
+NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+
+def estimate_text_tokens(text):
+    # Gemini's tokenizer averages about 4 characters per token on English text, while emoji and
+    # other non-ASCII characters usually cost a token each
+    non_ascii = len(NON_ASCII.findall(text))
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def estimate_tokens(api_contents):
+    return sum(estimate_text_tokens(part) if isinstance(part, str) else IMAGE_TOKENS for part in api_contents)
+
+
+def _is_retryable(error):
+    return getattr(error, 'code', None) in (429, 500, 502, 503, 504)
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+# What call_gemini hands back for a cached response. It iterates as a single chunk, so streaming
+# and non-streaming callers read it the same way as a real response.
+class CachedResponse:
+    def __init__(self, text, usage):
+        self.text = text
+        self.usage_metadata = type("CachedUsage", (), usage)() if usage else None
+
+    def __iter__(self):
+        yield self
+
+
+# Gemini responses stored one JSON file per request under the hash of everything that decides the
+# output: model, generation config, prompt text and image pixels. Streams are written once they
+# have been read to the end, so a response cut off mid-stream is never replayed as complete.
+class LLMCache:
+    def __init__(self, directory=LLM_CACHE_DIR, model_name=MODEL_CHOICE):
+        self.directory = directory
+        self.model_name = model_name
+
+    def key(self, api_contents, generation_config):
+        config = generation_config if isinstance(generation_config, dict) else vars(generation_config)
+        digest = hashlib.sha256(self.model_name.encode('utf-8'))
+        digest.update(json.dumps({k: v for k, v in config.items() if v is not None}, sort_keys=True, default=str).encode('utf-8'))
+        for part in api_contents:
+            if isinstance(part, str):
+                digest.update(b"text\0" + part.encode('utf-8'))
+            else:
+                digest.update(f"image\0{part.mode}\0{part.size}\0".encode('utf-8'))
+                digest.update(part.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return CachedResponse(entry["text"], entry.get("usage"))
+
+    def put(self, key, api_contents, text, usage):
+        usage = {name: getattr(usage, name, None) for name in ("prompt_token_count", "candidates_token_count")} if usage else None
+        write_json_atomic(self._path(key), {
+            "model": self.model_name,
+            "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "prompt_start": next((part for part in api_contents if isinstance(part, str)), "")[:200],
+            "text": text,
+            "usage": usage
+        })
+
+    def _record_stream(self, key, api_contents, stream):
+        chunks = []
+        usage = None
+        for chunk in stream:
+            chunks.append(chunk.text)
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            yield chunk
+        self.put(key, api_contents, "".join(chunks), usage)
+
+    def call(self, mode, api_contents, generation_config, stream, fetch):
+        key = self.key(api_contents, generation_config)
+        cached = self.get(key)
+        if cached is not None:
+            print(f"--- Using cached Gemini response {key[:12]} ---")
+            metrics.count("llm_cache_hits")
+            return cached
+        metrics.count("llm_cache_misses")
+        if mode == "replay":
+            raise LLMCacheMiss(f"No cached Gemini response {key[:12]} to replay")
+        response = fetch(api_contents, generation_config, stream)
+        if stream:
+            return self._record_stream(key, api_contents, response)
+        self.put(key, api_contents, response.text, getattr(response, "usage_metadata", None))
+        return response
+
+
+llm_cache = LLMCache()
+
+
+# Which headlines a run picks depends on the post history and the candidate queue as much as on the
+# responses, so a record run saves both under LLM_CACHE_DIR/state once it has harvested. A replay
+# starts from a fresh copy of that snapshot in LLM_CACHE_DIR/replay and keeps everything it builds
+# from it there too: the history-derived indexes, the fragment cache and the rendered pages, so the
+# live cache and the published feed are never touched.
+def save_llm_state():
+    state_dir = os.path.join(LLM_CACHE_DIR, "state")
+    os.makedirs(state_dir, exist_ok=True)
+    for name, source in (("post_history.db", get_post_history().conn), ("candidates.db", get_candidate_queue().conn)):
+        target = sqlite3.connect(os.path.join(state_dir, name))
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    print(f"--- Saved post history and candidate queue to {state_dir} for replay ---")
+
+
+def use_llm_state():
+    global HISTORY_DB, CANDIDATE_QUEUE_DB, CANDIDATE_MAX_AGE, SEEN_LINKS_FILE, HEADLINE_VECTORS_FILE, \
+        HEADLINE_INDEX_FILE, TOPIC_STATE_FILE, TOPIC_CENTROIDS_FILE, FRAGMENT_CACHE_DIR, OUTPUT_DIR, fragment_cache
+    state_dir = os.path.join(LLM_CACHE_DIR, "state")
+    sources = {"post_history.db": HISTORY_DB, "candidates.db": CANDIDATE_QUEUE_DB}
+    if os.path.exists(os.path.join(state_dir, "post_history.db")):
+        sources = {name: os.path.join(state_dir, name) for name in sources}
+        print(f"--- Replaying from the history and candidate queue recorded in {state_dir} ---")
+    else:
+        print(f"Warning: no recorded state in {state_dir}, replaying from a copy of the live history and candidate "
+              "queue. The prompts only match the recording if neither has changed since.")
+
+    replay_dir = os.path.join(LLM_CACHE_DIR, "replay")
+    shutil.rmtree(replay_dir, ignore_errors=True)
+    HISTORY_DB = os.path.join(replay_dir, HISTORY_DB)
+    CANDIDATE_QUEUE_DB = os.path.join(replay_dir, CANDIDATE_QUEUE_DB)
+    for name, target in (("post_history.db", HISTORY_DB), ("candidates.db", CANDIDATE_QUEUE_DB)):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(sources[name]):
+            shutil.copyfile(sources[name], target)
+    SEEN_LINKS_FILE = os.path.join(replay_dir, SEEN_LINKS_FILE)
+    HEADLINE_VECTORS_FILE = os.path.join(replay_dir, HEADLINE_VECTORS_FILE)
+    HEADLINE_INDEX_FILE = os.path.join(replay_dir, HEADLINE_INDEX_FILE)
+    TOPIC_STATE_FILE = os.path.join(replay_dir, TOPIC_STATE_FILE)
+    TOPIC_CENTROIDS_FILE = os.path.join(replay_dir, TOPIC_CENTROIDS_FILE)
+    FRAGMENT_CACHE_DIR = os.path.join(replay_dir, FRAGMENT_CACHE_DIR)
+    fragment_cache = FragmentCache(FRAGMENT_CACHE_DIR)
+    OUTPUT_DIR = replay_dir
+    CANDIDATE_MAX_AGE = float("inf")  # However old the recording is, its candidates are still the ones to pick
+    print(f"--- Replay output goes to {replay_dir} ---")
+
+
+def call_gemini(api_contents, generation_config, stream=False):
+    if LLM_CACHE_MODE in ("record", "replay"):
+        return llm_cache.call(LLM_CACHE_MODE, api_contents, generation_config, stream, _call_gemini)
+    return _call_gemini(api_contents, generation_config, stream)
+
+
+def _call_gemini(api_contents, generation_config, stream=False):
+    # With stream=True only errors raised before the first chunk are retried
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        rate_limiter.acquire(estimate_tokens(api_contents))
+        try:
+            return get_client().generate_content(contents=api_contents, generation_config=generation_config,
+                                                 stream=stream)
+        except Exception as e:
+            if not _is_retryable(e) or attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"--- Gemini call failed ({e}), retrying in {delay:.1f}s ---")
+            metrics.count("gemini_retries")
+            time.sleep(delay)
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if PROMPT_TOKEN_COUNTER == "gemini":
+        return get_client().count_tokens(text).total_tokens
+    return estimate_text_tokens(text)
 
 
 # Keep that API bill down
-def context_budgeter(text, max_length, keep_length):
+def context_budgeter(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Keep the end of the post, where the actual question or punchline usually is. The longest tail
+    # that fits is found by bisection, so the "gemini" counter makes a few calls instead of one per word
     words = text.split()
-    if len(words) > max_length:
-        last_words = words[-keep_length:]
-        return "[History cut off due to context limit being hit] " + " ".join(last_words)
+
+    def cut_off(kept):
+        return "[History cut off due to context limit being hit] " + " ".join(words[len(words) - kept:])
+
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(cut_off(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return cut_off(low)
+
+
+def format_personas(personas):
+    return "[" + ",".join(
+        p.fragment if isinstance(p, Persona) else json.dumps(p, ensure_ascii=False, separators=(',', ':'))
+        for p in personas) + "]"
+
+
+def format_slang(slang):
+    return "\n".join(f"{term}: {meaning}" for term, meaning in slang.items())
+
+
+def _post_content_prompt(post_title, post_body, has_image):
+    post_content_prompt = f"Here is the headline: \"{post_title}\"\n"
+    if post_body:
+        post_content_prompt += f"Here is the body of the post:\n---\n{post_body}\n---\n\n"
     else:
-        return text
+        post_content_prompt += "\n"
+    if has_image:
+        post_content_prompt = "The user has provided an image along with the post title. Analyze the image first, then the text. Your comments MUST reflect that you have seen and understood the image. " + post_content_prompt
+    return post_content_prompt
+
+
+def _prompt_sections(posts, personas, slang):
+    if len(posts) == 1:
+        post_title, post_body, image_object = posts[0]
+        post_prompt = _post_content_prompt(post_title, post_body, image_object is not None)
+    else:
+        # Images can't sit inside the text, so they are named by post id and follow it in order
+        post_prompt = "".join(
+            f"--- {batch_key(i)} ---\n"
+            + _post_content_prompt(post_title, post_body, False)
+            + (f"The image for {batch_key(i)} is attached below the instructions, labelled with its post id. Analyze it first, then the text. Your comments MUST reflect that you have seen and understood the image.\n\n" if image_object is not None else "")
+            for i, (post_title, post_body, image_object) in enumerate(posts))
+
+    return {
+        "personas": f"Here are your personas: {format_personas(personas)}\n\n",
+        "slang": f"You should incorporate some of the following slang terms across many of the comments even if it is out of character in order to create a more realistic online environment:\n{format_slang(slang)}\n" if slang else "",
+        "post_body": post_prompt,
+    }
+
+
+def batch_key(i):
+    return f"post_{i + 1}"
+
+
+def build_prompt(post_title, post_body, image_object, personas, slang):
+    return build_batch_prompt([(post_title, post_body, image_object)], personas, slang)
+
+
+# With more than one post the result asks for a JSON object keyed by batch_key(i) instead of a list
+def build_batch_prompt(posts, personas, slang):
+    posts = [list(post) for post in posts]
+    personas = list(personas)
+    slang = dict(slang)
+    batched = len(posts) > 1
+    counted = {}
+
+    def count(text):
+        if text not in counted:
+            counted[text] = count_tokens(text)
+        return counted[text]
+
+    def measure():
+        sections = _prompt_sections(posts, personas, slang)
+        fixed = (PROMPT_BATCH_INTRO + PROMPT_BATCH_NOTE) if batched else PROMPT_INTRO
+        tokens = {"instructions": count(fixed + PROMPT_SHORT_FORM_NOTE + PROMPT_INSTRUCTIONS)}
+        tokens.update({name: count(text) for name, text in sections.items()})
+        tokens["image"] = IMAGE_TOKENS * sum(post[2] is not None for post in posts)
+        return sections, tokens
+
+    # Shorten sections in PROMPT_TRIM_ORDER until the prompt fits, each only as far as it has to
+    sections, tokens = measure()
+    for name in PROMPT_TRIM_ORDER:
+        if sum(tokens.values()) <= PROMPT_TOKEN_BUDGET:
+            break
+        if name == "post_body":
+            # Longest body first, so short posts in a batch keep theirs
+            for post in sorted(posts, key=lambda post: count(post[1]), reverse=True):
+                if not post[1] or sum(tokens.values()) <= PROMPT_TOKEN_BUDGET:
+                    break
+                overflow = sum(tokens.values()) - PROMPT_TOKEN_BUDGET
+                post[1] = context_budgeter(post[1], max(PROMPT_MIN_BODY_TOKENS, count(post[1]) - overflow))
+                sections, tokens = measure()
+        elif name == "slang":
+            while slang and sum(tokens.values()) > PROMPT_TOKEN_BUDGET:
+                slang.popitem()
+                sections, tokens = measure()
+        elif name == "personas":
+            while len(personas) > PROMPT_MIN_PERSONAS and sum(tokens.values()) > PROMPT_TOKEN_BUDGET:
+                personas.pop()
+                sections, tokens = measure()
+
+    total = sum(tokens.values())
+    print("--- Prompt tokens: " + ", ".join(f"{name} {count}" for name, count in tokens.items())
+          + f" | total {total} of {PROMPT_TOKEN_BUDGET} ---")
+    if total > PROMPT_TOKEN_BUDGET:
+        print("Warning: prompt is still over budget after trimming every section in PROMPT_TRIM_ORDER.")
+
+    reddit_prompt = (
+        (PROMPT_BATCH_INTRO if batched else PROMPT_INTRO)
+        + sections["personas"]
+        + sections["slang"]
+        + PROMPT_SHORT_FORM_NOTE
+        + sections["post_body"]
+        + PROMPT_INSTRUCTIONS
+        + (PROMPT_BATCH_NOTE if batched else "")
+    )
+    api_contents = [reddit_prompt]
+    for i, (_, _, image_object) in enumerate(posts):
+        if image_object:
+            print("Image object found, adding to prompt.")
+            if batched:
+                api_contents.append(f"Image for {batch_key(i)}:")
+            api_contents.append(image_object)
+    return api_contents
 
 
-def get_historical_links():
+def _parse_post_timestamp(timestamp):
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        history = []
+        return datetime.strptime(timestamp, "%B %d, %Y at %H:%M UTC").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# Posts are appended as rows (newest = highest id) so writes don't touch older posts and
+# reading the latest MAX_POSTS_TO_DISPLAY only decodes those rows.
+class PostHistory:
+    def __init__(self, path=HISTORY_DB, legacy_path=HISTORY_FILE):
+        # Created lazily, possibly on a worker thread; the sqlite3 module serializes access to the connection
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                link TEXT,
+                title TEXT,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_posts_link ON posts (link);
+            CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at);
+        """)
+        if len(self) == 0 and legacy_path and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+
+    def migrate(self, legacy_path):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                history = json.load(f)
+        except json.JSONDecodeError as e:
+            print(f"Could not migrate {legacy_path}: {e}")
+            return
+
+        # The legacy file is newest first
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO posts (link, title, created_at, data) VALUES (?, ?, ?, ?)",
+                (self._row(post, _parse_post_timestamp(post.get('timestamp'))) for post in reversed(history)))
+        print(f"--- Migrated {len(history)} posts from {legacy_path} to {HISTORY_DB} ---")
+
+    @staticmethod
+    def _row(post, created_at):
+        headline = post.get('headline', {})
+        return headline.get('link'), headline.get('title'), created_at, json.dumps(post, default=json_default)
+
+    def append(self, post):
+        with self.conn:
+            self.conn.execute("INSERT INTO posts (link, title, created_at, data) VALUES (?, ?, ?, ?)",
+                              self._row(post, time.time()))
+
+    @staticmethod
+    def _decode(data):
+        # Posts written before comments were validated may hold any shape the model produced
+        post = json.loads(data)
+        post['comments'] = normalize_comments(post.get('comments'))[0]
+        return post
+
+    def latest(self, n):
+        rows = self.conn.execute("SELECT data FROM posts ORDER BY id DESC LIMIT ?", (n,))
+        return [self._decode(data) for data, in rows]
+
+    def get_by_link(self, link):
+        row = self.conn.execute("SELECT data FROM posts WHERE link = ? ORDER BY id DESC LIMIT 1", (link,)).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def links(self):
+        return (link for link, in self.conn.execute("SELECT link FROM posts WHERE link IS NOT NULL"))
+
+    def titles(self):
+        return (title for title, in self.conn.execute("SELECT title FROM posts WHERE title IS NOT NULL ORDER BY id"))
+
+    def __iter__(self):
+        return (self._decode(data) for data, in self.conn.execute("SELECT data FROM posts ORDER BY id DESC"))
+
+    def since(self, row_id):
+        # (row id, post) for every post appended after row_id, oldest first
+        rows = self.conn.execute("SELECT id, data FROM posts WHERE id > ? ORDER BY id", (row_id,))
+        return ((post_id, self._decode(data)) for post_id, data in rows)
+
+    def count_through(self, row_id):
+        return self.conn.execute("SELECT COUNT(*) FROM posts WHERE id <= ?", (row_id,)).fetchone()[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+
+def get_post_history():
+    return _resource("post_history", lambda: PostHistory(HISTORY_DB))
+
+
+REDDIT_POST_PATH = re.compile(r"^/r/[^/]+/comments/([a-z0-9]+)")
+
+
+def normalize_link(link):
+    parts = urlsplit(link.strip())
+    host = parts.netloc.lower()
+    path = parts.path.rstrip('/')
+    if host == "reddit.com" or host.endswith(".reddit.com") or host == "redd.it":
+        # Subreddit casing, the title slug, old./np. hosts and query strings all point at the same post
+        match = REDDIT_POST_PATH.match(path.lower())
+        if match:
+            return f"reddit.com/comments/{match.group(1)}"
+        if host == "redd.it" and path:
+            return f"reddit.com/comments/{path.lstrip('/').lower()}"
+        host = "reddit.com"
+    elif host.startswith("www."):
+        host = host[4:]
+    return f"{host}{path}"
+
+
+def _link_key(link):
+    return int.from_bytes(hashlib.blake2b(normalize_link(link).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# Sorted 64-bit hashes of every normalized posted link. Loading is a single array read and a lookup
+# is a binary search; the file is rebuilt from the history whenever their post counts disagree.
+class SeenLinks:
+    def __init__(self, history, path=SEEN_LINKS_FILE):
+        self.history = history
+        self.path = path
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.count = 0
+        try:
+            with np.load(self.path) as arrays:
+                self.keys, self.count = arrays['keys'], int(arrays['count'])
+        except (OSError, KeyError, ValueError):
+            pass
+        if self.count != len(history):
+            self.rebuild()
+
+    def rebuild(self):
+        keys = np.array([_link_key(link) for link in self.history.links()], dtype=np.uint64)
+        self.keys = np.unique(keys)
+        self.count = len(self.history)
+        print(f"--- Rebuilt seen-link index with {len(self.keys)} links ---")
+        self.save()
+
+    def save(self):
+        save_npz_atomic(self.path, keys=self.keys, count=np.int64(self.count))
+
+    def _find(self, key):
+        position = int(np.searchsorted(self.keys, key))
+        return position, position < len(self.keys) and self.keys[position] == key
+
+    def __contains__(self, link):
+        return self._find(np.uint64(_link_key(link)))[1]
+
+    def add(self, link):
+        if link:
+            key = np.uint64(_link_key(link))
+            position, found = self._find(key)
+            if not found:
+                self.keys = np.insert(self.keys, position, key)
+        self.count += 1
+        self.save()
+
 
-    historical_links = set()
-    for post in history:
-        if 'headline' in post and 'link' in post['headline']:
-            historical_links.add(post['headline']['link'])
-    return historical_links
+def get_seen_links():
+    return _resource("seen_links", lambda: SeenLinks(get_post_history(), SEEN_LINKS_FILE))
 
 
-def get_headline(feed_url):
-    print(f"Fetching {feed_url}")
-    feed = feedparser.parse(feed_url)
+def fetch_feed(feed_url):
+    feedparser = _import("feedparser")
+    requests = _import("requests")
+    try:
+        with metrics.stage("feed_fetch"):
+            response = http_get(feed_url, FEED_TIMEOUT, headers={"User-Agent": feedparser.USER_AGENT})
+            response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Could not fetch {feed_url}: {e}")
+        metrics.count("feeds_failed")
+        return []
+    metrics.count("feed_bytes", len(response.content))
 
+    headers = {key.lower(): value for key, value in response.headers.items()}
+    headers.setdefault("content-location", feed_url)
+    with metrics.stage("feed_parse"):
+        feed = feedparser.parse(response.content, response_headers=headers)
     if feed.bozo:
-        print(f"Error parsing feed: {feed.bozo_exception}")
-        return None
+        print(f"Error parsing feed {feed_url}: {feed.bozo_exception}")
+        metrics.count("feeds_failed")
+        return []
     if not feed.entries:
-        print("No entries found in the RSS feed.")
-        return None
+        print(f"No entries found in {feed_url}.")
+    return feed.entries
+
+
+FEED_SUBREDDIT = re.compile(r"/r/([^/]+)/")
+
+
+def feed_subreddit(feed_url):
+    match = FEED_SUBREDDIT.search(feed_url)
+    return match.group(1).lower() if match else feed_url
+
+
+def candidate_from_entry(entry, subreddit):
+    post_body = ""
+    image_url = None
+    if hasattr(entry, 'content'):
+        BeautifulSoup = _import("bs4").BeautifulSoup
+        soup = BeautifulSoup(entry.content[0].value, 'html.parser')
+        post_body = soup.get_text(separator='\n', strip=True)
+        image_link_tag = soup.find('a', string='[link]')
+        if image_link_tag and image_link_tag.get('href'):
+            href = image_link_tag['href']
+            if any(ext in href.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
+                image_url = href
+    return {
+        "title": entry.title,
+        "link": entry.link,
+        "author": entry.author,
+        "subreddit": subreddit,
+        "body": post_body,
+        "image_url": image_url
+    }
+
+
+# Harvested headlines waiting to be posted, so generation pops one without fetching anything and a
+# run still has something to post when its feeds are down or already used up. Candidates expire
+# CANDIDATE_MAX_AGE after they were harvested. A pop takes the oldest candidate of the subreddit whose
+# turn is furthest back, so one busy subreddit can't crowd out the others; it touches one index entry
+# per subreddit, not the queue. A popped candidate is only claimed: it is deleted once its post is in
+# the history (or it was skipped), and released back to the front of its subreddit if generation
+# fails. Claims left by a run that died are released when the queue is next opened.
+class CandidateQueue:
+    def __init__(self, path=CANDIDATE_QUEUE_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS candidates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                link_key TEXT NOT NULL UNIQUE,
+                subreddit TEXT NOT NULL,
+                harvested_at REAL NOT NULL,
+                data TEXT NOT NULL,
+                claimed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_candidates_unclaimed ON candidates (subreddit, claimed, id);
+            CREATE INDEX IF NOT EXISTS idx_candidates_harvested_at ON candidates (harvested_at);
+            CREATE TABLE IF NOT EXISTS subreddits (
+                name TEXT PRIMARY KEY,
+                turn INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        self.release_claims()
+
+    def __contains__(self, link):
+        return self.conn.execute("SELECT 1 FROM candidates WHERE link_key = ?", (normalize_link(link),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM candidates").fetchone()[0]
+
+    def titles(self):
+        return [json.loads(data)["title"] for (data,) in self.conn.execute("SELECT data FROM candidates")]
+
+    def _expire(self):
+        expired = self.conn.execute("DELETE FROM candidates WHERE harvested_at < ?", (time.time() - CANDIDATE_MAX_AGE,)).rowcount
+        if expired:
+            print(f"--- Dropped {expired} queued headlines older than {CANDIDATE_MAX_AGE // 3600}h ---")
+            metrics.count("candidates_expired", expired)
+
+    def add(self, candidates):
+        now = time.time()
+        with self.lock, self.conn:
+            added = 0
+            for candidate in candidates:
+                self.conn.execute("INSERT OR IGNORE INTO subreddits (name) VALUES (?)", (candidate["subreddit"],))
+                added += self.conn.execute(
+                    "INSERT OR IGNORE INTO candidates (link_key, subreddit, harvested_at, data) VALUES (?, ?, ?, ?)",
+                    (normalize_link(candidate["link"]), candidate["subreddit"], now, json.dumps(candidate))).rowcount
+            for subreddit in {candidate["subreddit"] for candidate in candidates}:
+                self.conn.execute("""
+                    DELETE FROM candidates WHERE subreddit = ? AND id NOT IN (
+                        SELECT id FROM candidates WHERE subreddit = ? ORDER BY id DESC LIMIT ?)
+                """, (subreddit, subreddit, CANDIDATE_MAX_PER_SUBREDDIT))
+            self._expire()
+        return added
+
+    def pop(self):
+        with self.lock, self.conn:
+            self._expire()
+            row = self.conn.execute("""
+                SELECT c.id, c.subreddit, c.data FROM subreddits s
+                JOIN candidates c ON c.id = (
+                    SELECT id FROM candidates WHERE subreddit = s.name AND claimed = 0 ORDER BY id LIMIT 1)
+                ORDER BY s.turn, s.name LIMIT 1
+            """).fetchone()
+            if row is None:
+                return None
+            row_id, subreddit, data = row
+            self.conn.execute("UPDATE candidates SET claimed = 1 WHERE id = ?", (row_id,))
+            self.conn.execute("UPDATE subreddits SET turn = (SELECT MAX(turn) FROM subreddits) + 1 WHERE name = ?",
+                              (subreddit,))
+        return json.loads(data)
+
+    def complete(self, link):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM candidates WHERE link_key = ?", (normalize_link(link),))
+
+    def release(self, link):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE candidates SET claimed = 0 WHERE link_key = ?", (normalize_link(link),))
+
+    def release_claims(self):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE candidates SET claimed = 0 WHERE claimed = 1")
+
+
+def get_candidate_queue():
+    return _resource("candidate_queue", lambda: CandidateQueue(CANDIDATE_QUEUE_DB))
+
+
+def harvest_candidates(feed_urls):
+    print(f"Fetching {len(feed_urls)} feeds with up to {FEED_FETCH_CONCURRENCY} at a time")
+    with ThreadPoolExecutor(max_workers=FEED_FETCH_CONCURRENCY) as pool:
+        feeds = list(pool.map(fetch_feed, feed_urls))
+
+    candidate_queue = get_candidate_queue()
+    seen_links = get_seen_links()
+    candidates = []
+    queued_links = set()
+    for feed_url, entries in zip(feed_urls, feeds):
+        checked_entries = 0
+        for entry in entries:
+            if not hasattr(entry, 'author'):
+                continue
+            if entry.author in FILTERED_USERS:
+                continue
+
+            checked_entries += 1
+            if checked_entries > MAX_CHECKED_ENTRIES_PER_FEED:
+                break
+
+            link_key = normalize_link(entry.link)
+            if entry.link in seen_links or link_key in queued_links or entry.link in candidate_queue:
+                continue
+            queued_links.add(link_key)
+            candidates.append(candidate_from_entry(entry, feed_subreddit(feed_url)))
+
+    with metrics.stage("near_duplicates"):
+        candidates = drop_near_duplicates(candidates, candidate_queue.titles())
+    added = candidate_queue.add(candidates)
+    metrics.count("candidates", added)
+    print(f"Queued {added} new headlines from {len(feed_urls)} feeds, {len(candidate_queue)} waiting")
+    return candidate_queue
+
+
+def is_posted_duplicate(title, vector=None):
+    # Crossposts have their own links, so a title this close to a posted headline counts as a repost
+    if DUPLICATE_SIMILARITY > 1:
+        return False
+    if vector is None:
+        vector = _unit(get_embedding_store().get_embeddings([title]))[0]
+    similarity = get_headline_index().nearest(vector)
+    if similarity < DUPLICATE_SIMILARITY:
+        return False
+    print(f"Skipping near-duplicate of a posted headline ({similarity:.2f}): \"{title}\"")
+    metrics.count("near_duplicates_skipped")
+    return True
+
+
+def drop_near_duplicates(candidates, queued_titles=()):
+    # Crossposts have their own links, so compare titles against posted headlines, the headlines
+    # already queued by earlier harvests and each other
+    if not candidates or DUPLICATE_SIMILARITY > 1:
+        return candidates
+    store = get_embedding_store()
+    vectors = _unit(store.get_embeddings([candidate["title"] for candidate in candidates]))
+    kept, kept_vectors = [], list(_unit(store.get_embeddings(list(queued_titles)))) if queued_titles else []
+    for candidate, vector in zip(candidates, vectors):
+        if is_posted_duplicate(candidate["title"], vector):
+            continue
+        if kept_vectors and float(np.max(np.stack(kept_vectors) @ vector)) >= DUPLICATE_SIMILARITY:
+            print(f"Skipping near-duplicate of another queued headline: \"{candidate['title']}\"")
+            metrics.count("near_duplicates_skipped")
+            continue
+        kept.append(candidate)
+        kept_vectors.append(vector)
+    return kept
+
+
+def _image_cache_path(image_url):
+    return os.path.join(IMAGE_CACHE_DIR, hashlib.sha1(image_url.encode('utf-8')).hexdigest())
+
+
+def download_image(image_url):
+    # Streamed so an oversized or mislabelled file is dropped before it is all in memory
+    with http_get(image_url, IMAGE_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type not in IMAGE_CONTENT_TYPES:
+            raise ValueError(f"unexpected content type '{content_type or 'none'}'")
+        if int(response.headers.get("Content-Length") or 0) > IMAGE_MAX_BYTES:
+            raise ValueError(f"image is {response.headers['Content-Length']} bytes, limit is {IMAGE_MAX_BYTES}")
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data.extend(chunk)
+            if len(data) > IMAGE_MAX_BYTES:
+                raise ValueError(f"image exceeds {IMAGE_MAX_BYTES} bytes")
+    return bytes(data)
+
+
+def make_thumbnail(data):
+    Image = _import("PIL.Image")
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG":
+        # Let the decoder downscale by a power of two instead of decoding every full-size pixel
+        img.draft("RGB", IMAGE_THUMBNAIL_SIZE)
+    img.thumbnail(IMAGE_THUMBNAIL_SIZE)
+    if img.mode in ("RGBA", "LA", "P"):
+        img_format, options = "PNG", {"optimize": True}
+    else:
+        img = img.convert("RGB")
+        img_format, options = "JPEG", {"quality": 90}
+    encoded = io.BytesIO()
+    img.save(encoded, format=img_format, **options)
+    return encoded.getvalue()
 
-    historical_links = get_historical_links()
 
-    checked_post_attempts = 0
-    max_checked_post_attempts = 10
+def load_image(image_url):
+    Image = _import("PIL.Image")
+    path = _image_cache_path(image_url)
+    try:
+        with open(path, 'rb') as f:
+            img = Image.open(io.BytesIO(f.read()))
+            img.load()
+        print("Using cached thumbnail for image.")
+        metrics.count("image_cache_hits")
+        return img
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Ignoring unreadable cached thumbnail {path}: {e}")
 
-    for entry in feed.entries:
-        if not hasattr(entry, 'author'):
-            continue
-        if entry.author in FILTERED_USERS:
-            continue
+    requests = _import("requests")
+    try:
+        with metrics.stage("image_download"):
+            data = download_image(image_url)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Could not download image: {e}")
+        metrics.count("images_failed")
+        return None
+    metrics.count("image_bytes", len(data))
+    try:
+        with metrics.stage("image_resize"):
+            thumbnail = make_thumbnail(data)
+            img = Image.open(io.BytesIO(thumbnail))
+            img.load()
+    except Exception as e:
+        metrics.count("images_failed")
+        print(f"Could not process image: {e}")
+        return None
 
-        checked_post_attempts += 1
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(thumbnail)
+    os.replace(path + ".tmp", path)
+    print(f"Successfully downloaded and resized image ({len(data)} bytes -> {len(thumbnail)} bytes cached).")
+    return img
 
-        if checked_post_attempts > max_checked_post_attempts:
-            print(f"Exceeded {max_checked_post_attempts} attempts to find a new headline among non-filtered posts.")
-            break
 
-        if entry.link in historical_links:
-            print(f"Skipping previously posted headline: \"{entry.title}\" by {entry.author}")
+def get_headline(candidates):
+    seen_links = get_seen_links()
+    while True:
+        candidate = candidates.pop()
+        if candidate is None:
+            break
+        if candidate["link"] in seen_links:
+            print(f"Skipping previously posted headline: \"{candidate['title']}\" by {candidate['author']}")
+            candidates.complete(candidate["link"])
+            continue
+        # Something close may have been posted since this was queued
+        if is_posted_duplicate(candidate["title"]):
+            candidates.complete(candidate["link"])
             continue
 
-        print(f"Found valid and new headline: \"{entry.title}\" by {entry.author}")
+        print(f"Found valid and new headline: \"{candidate['title']}\" by {candidate['author']} in r/{candidate['subreddit']}")
 
-        post_body = ""
         image_object = None
-
-        if hasattr(entry, 'content'):
-            html_content = entry.content[0].value
-            soup = BeautifulSoup(html_content, 'html.parser')
-            post_body = soup.get_text(separator='\n', strip=True)
-            image_link_tag = soup.find('a', string='[link]')
-            if image_link_tag and image_link_tag['href']:
-                image_url = image_link_tag['href']
-                if any(ext in image_url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                    print(f"Found image URL: {image_url}")
-                    try:
-                        response = requests.get(image_url, timeout=10)
-                        response.raise_for_status()
-
-                        img = Image.open(io.BytesIO(response.content))
-                        img.thumbnail((768, 768))
-
-                        image_object = img
-                        print("Successfully downloaded and resized image.")
-
-                    except requests.exceptions.RequestException as e:
-                        print(f"Could not download image: {e}")
-                    except Exception as e:
-                        print(f"Could not process image: {e}")
+        if candidate["image_url"]:
+            print(f"Found image URL: {candidate['image_url']}")
+            image_object = load_image(candidate["image_url"])
 
         return {
-            "title": entry.title,
-            "link": entry.link,
-            "body": post_body,
+            "title": candidate["title"],
+            "link": candidate["link"],
+            "body": candidate["body"],
             "image_object": image_object
         }
 
-    print(
-        "Could not find a new post (not by a filtered user and not previously posted) in the recent entries after several attempts.")
+    print("Could not find a new post (not by a filtered user and not previously posted) in the candidate queue.")
     return None
 
 
@@ -363,7 +1982,8 @@ def repair_and_parse_json(text: str):
 
     try:
         data = json.loads(text)
-        return _clean_parsed_json(data)
+        metrics.count("json_parsed_directly")
+        return data
     except json.JSONDecodeError as e:
         print(f"\n--- Initial JSON parse failed: {e}. Attempting repairs. ---")
 
@@ -371,164 +1991,455 @@ def repair_and_parse_json(text: str):
     try:
         print("--- Trying to parse again after cleaning escaped quotes... ---")
         data = json.loads(repaired_text)
-        return _clean_parsed_json(data)
+        metrics.count("json_repaired_quotes")
+        return data
     except json.JSONDecodeError as e2:
         print(f"--- Cleaning escaped quotes did not fix the issue: {e2}. ---")
 
     if not text.startswith('['):
         print("--- Repair failed: Text does not start with a list character '['. ---")
+        metrics.count("json_failed")
         return None
 
-    last_valid_pos = text.rfind('}')
-    if last_valid_pos == -1:
-        print("--- Repair failed: Could not find any closing brace in the JSON string. ---")
+    print("--- Attempting to salvage truncated JSON... ---")
+    parser = CommentStreamParser()
+    parser.feed(text)
+    salvaged = parser.result()
+    if not salvaged:
+        print("--- Repair failed: No complete comment could be salvaged. ---")
+        metrics.count("json_failed")
         return None
+    metrics.count("json_salvaged")
+    print(f"--- Successfully salvaged {len(salvaged)} top-level comments from truncated output. ---")
+    return salvaged
+
+
+DELETED_COMMENT = "[Message has been deleted by moderator]"
+MARKDOWN_CHARACTERS = str.maketrans("", "", "*\\")
+UPVOTES_PATTERN = re.compile(r"(-?\d+(?:\.\d+)?)\s*([km]?)")
+
+
+# One validated comment. Everything after parsing (rendering, the history, the client data) works
+# on these; json_default turns them back into the plain comment objects the history stores.
+class CommentNode:
+    __slots__ = ("author", "text", "upvotes", "replies")
 
-    truncated_text = text[:last_valid_pos + 1]
-    repaired_json_text = truncated_text + "\n]"
+    def __init__(self, author, text, upvotes, replies):
+        self.author = author
+        self.text = text
+        self.upvotes = upvotes
+        self.replies = replies
 
-    print("--- Attempting to parse repaired truncated JSON... ---")
+    def as_dict(self):
+        return {"author": self.author, "comment": self.text, "upvotes": self.upvotes, "replies": self.replies}
+
+
+class CommentStats:
+    __slots__ = ("comments", "max_depth", "short_comments", "authors", "dropped")
+
+    def __init__(self):
+        self.comments = 0
+        self.max_depth = 0
+        self.short_comments = 0
+        self.authors = set()
+        self.dropped = 0
+
+    @property
+    def short_ratio(self):
+        return self.short_comments / self.comments if self.comments else 0.0
+
+
+def json_default(obj):
+    if isinstance(obj, CommentNode):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _coerce_upvotes(value):
+    if isinstance(value, str):
+        # The model sometimes writes "1.2k" or "35 points"
+        match = UPVOTES_PATTERN.match(value.strip().lower().replace(",", ""))
+        if not match:
+            return 1
+        value = float(match.group(1)) * {"": 1, "k": 1000, "m": 1000000}[match.group(2)]
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return 1
+
+
+# Validates a parsed comment section in one iterative pass: non-object comments are dropped, fields
+# get their types and defaults, markdown is stripped from comment text only, and reply trees are cut
+# to COMMENT_MAX_DEPTH levels and COMMENT_MAX_REPLIES per list. Also takes sections that are
+# already normalized, like the ones read back from the history.
+def normalize_comments(raw_comments):
+    stats = CommentStats()
+    roots = []
+    if isinstance(raw_comments, dict):
+        raw_comments = [raw_comments]
+    stack = [(raw_comments if isinstance(raw_comments, list) else [], roots, 1)]
+    while stack:
+        raw_list, nodes, depth = stack.pop()
+        stats.dropped += max(0, len(raw_list) - COMMENT_MAX_REPLIES)
+        for raw in raw_list[:COMMENT_MAX_REPLIES]:
+            if isinstance(raw, CommentNode):
+                raw = raw.as_dict()
+            elif not isinstance(raw, dict):
+                stats.dropped += 1
+                continue
+
+            author = raw.get("author")
+            author = str(author).strip() if author is not None else ""
+            text = raw.get("comment")
+            if text is None:
+                text = DELETED_COMMENT
+            elif isinstance(text, str):
+                text = text.translate(MARKDOWN_CHARACTERS)
+            else:
+                text = str(text)
+            node = CommentNode(author or "Anonymous", text, _coerce_upvotes(raw.get("upvotes", 1)), [])
+            nodes.append(node)
+
+            stats.comments += 1
+            stats.max_depth = max(stats.max_depth, depth)
+            stats.short_comments += len(text) <= SHORT_COMMENT_CHARS
+            stats.authors.add(node.author)
+
+            replies = raw.get("replies")
+            if isinstance(replies, dict):
+                replies = [replies]
+            if isinstance(replies, list) and replies:
+                if depth < COMMENT_MAX_DEPTH:
+                    stack.append((replies, node.replies, depth + 1))
+                else:
+                    stats.dropped += len(replies)
+    return roots, stats
+
+
+def _loads_comment(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
     try:
-        repaired_data = json.loads(repaired_json_text)
-        print(f"--- Successfully salvaged {len(repaired_data)} top-level comments from truncated output. ---")
-        return _clean_parsed_json(repaired_data)
-    except json.JSONDecodeError as e3:
-        print(f"--- Final repair attempt failed: {e3} ---")
-        print("--- The truncated and repaired JSON was: ---")
-        print(repaired_json_text)
+        return json.loads(text.replace('\\"', '"'))
+    except json.JSONDecodeError as e:
+        print(f"--- Dropping a comment that is not valid JSON: {e} ---")
         return None
 
 
-def _clean_parsed_json(obj):
-    if isinstance(obj, dict):
-        return {k: _clean_parsed_json(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [_clean_parsed_json(elem) for elem in obj]
-    if isinstance(obj, str):
-        return obj.replace('*', '').replace('\\', '')
-    return obj
+def _prune_partial_replies(comment):
+    # A cut can leave reply objects that never got their text; drop them rather than render blanks
+    stack = [comment]
+    while stack:
+        node = stack.pop()
+        replies = node.get('replies')
+        if isinstance(replies, list):
+            node['replies'] = [reply for reply in replies if isinstance(reply, dict) and 'comment' in reply]
+            stack.extend(node['replies'])
+    return comment
+
+
+# Incremental parser for the top-level comment list. Each top-level comment is returned by feed()
+# as soon as its closing brace arrives. While a comment is still open it remembers the last position
+# where the text could be cut and closed into valid JSON, so result() can salvage a cut-off comment
+# together with whatever part of its reply tree was already complete.
+class CommentStreamParser:
+    def __init__(self):
+        self.comments = []
+        self.started = False
+        self.done = False
+        self.buffer = []
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_is_key = False
+        self.expect_key = False
+        self.in_primitive = False
+        self.safe_cut = None  # (buffer length, closing brackets) of the last clean cut point
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            comment = self._consume(ch)
+            if comment is not None:
+                completed.append(comment)
+        return completed
+
+    def _mark_safe(self, length):
+        closers = "".join('}' if opener == '{' else ']' for opener in reversed(self.stack))
+        self.safe_cut = (length, closers)
+
+    def _consume(self, ch):
+        if self.done:
+            return None
+        if not self.started:
+            self.started = ch == '['
+            return None
+        if not self.stack:
+            # Between top-level comments
+            if ch == '{':
+                self.buffer = [ch]
+                self.stack = ['{']
+                self.expect_key = True
+                self.safe_cut = None
+            elif ch == ']':
+                self.done = True
+            return None
+
+        self.buffer.append(ch)
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif ch == '\\':
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+                if not self.string_is_key:
+                    self._mark_safe(len(self.buffer))
+            return None
+
+        if self.in_primitive:
+            if ch not in ',}] \t\r\n':
+                return None
+            self.in_primitive = False
+            self._mark_safe(len(self.buffer) - 1)
+
+        if ch == '"':
+            self.in_string = True
+            self.string_is_key = self.stack[-1] == '{' and self.expect_key
+        elif ch in '{[':
+            self.stack.append(ch)
+            self.expect_key = ch == '{'
+        elif ch in '}]':
+            self.stack.pop()
+            self.expect_key = False
+            if not self.stack:
+                return self._complete()
+            self._mark_safe(len(self.buffer))
+        elif ch == ':':
+            self.expect_key = False
+        elif ch == ',':
+            self.expect_key = self.stack[-1] == '{'
+        elif not ch.isspace():
+            self.in_primitive = True
+        return None
 
+    def _complete(self):
+        comment = _loads_comment("".join(self.buffer))
+        self.buffer = []
+        if isinstance(comment, dict):
+            self.comments.append(comment)
+            return comment
+        return None
 
-def generate_reddit_comments(post_title, post_body, image_object=None):
-    post_content_prompt = f"Here is the headline: \"{post_title}\"\n"
-    if post_body:
-        post_content_prompt += f"Here is the body of the post:\n---\n{context_budgeter(post_body, CONTEXT_WINDOW, CONTEXT_WINDOW)}\n---\n\n"
+    def salvage(self):
+        # The comment that was still open when the text ended, cut at its last clean point
+        if not self.stack or self.safe_cut is None:
+            return None
+        length, closers = self.safe_cut
+        try:
+            comment = json.loads("".join(self.buffer[:length]) + closers)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(comment, dict) or 'comment' not in comment:
+            return None
+        return _prune_partial_replies(comment)
+
+    def result(self):
+        partial = self.salvage()
+        return self.comments + [partial] if partial else list(self.comments)
+
+
+def count_gemini_usage(api_contents, raw_text, usage):
+    # Gemini's own counts when the response carried them, the local estimate otherwise
+    tokens_in = getattr(usage, "prompt_token_count", 0) or estimate_tokens(api_contents)
+    tokens_out = getattr(usage, "candidates_token_count", 0) or estimate_text_tokens(raw_text)
+    metrics.count("tokens_in", tokens_in)
+    metrics.count("tokens_out", tokens_out)
+
+
+def finish_comment_section(raw_comments):
+    comments, stats = normalize_comments(raw_comments)
+    metrics.count("comments_parsed", stats.comments)
+    metrics.count("comments_dropped", stats.dropped)
+    if comments:
+        print(f"--- {stats.comments} comments by {len(stats.authors)} personas, {stats.max_depth} levels deep, "
+              f"{stats.short_ratio:.0%} short ---")
+    return comments or None
+
+
+def stream_comments(api_contents, generation_config):
+    parser = CommentStreamParser()
+    chunks = []
+    usage = None
+    try:
+        with metrics.stage("gemini"):
+            for chunk in call_gemini(api_contents, generation_config, stream=True):
+                chunks.append(chunk.text)
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                for comment in parser.feed(chunk.text):
+                    print(f"--- Received comment {len(parser.comments)} from {comment.get('author', 'Anonymous')} ---")
+    except Exception as e:
+        if not chunks:
+            raise
+        print(f"--- Response stream broke off: {e}. Keeping what arrived. ---")
+        metrics.count("gemini_streams_broken")
+
+    raw_text = "".join(chunks)
+    count_gemini_usage(api_contents, raw_text, usage)
+    if not parser.started:
+        # Not the list we asked for, let the full-text repairs have a go
+        return repair_and_parse_json(raw_text), raw_text
+    if not parser.done:
+        print(f"--- Response was cut off after {len(parser.comments)} complete top-level comments, salvaging. ---")
+        metrics.count("json_salvaged")
     else:
-        post_content_prompt += "\n"
+        metrics.count("json_streamed")
+    return parser.result() or None, raw_text
 
-    api_contents = []
 
-    if image_object:
-        print("Image object found, adding to prompt.")
-        api_contents.append(image_object)
-        post_content_prompt = "The user has provided an image along with the post title. Analyze the image first, then the text. Your comments MUST reflect that you have seen and understood the image. " + post_content_prompt
-
-    reddit_prompt = (
-        f"You are an API that generates a simulated Reddit comment section for a given headline. "
-        f"Your final output must be a single, valid JSON object and nothing else. Do not include any explanatory text before or after the JSON. "
-        f"The JSON object should be a list of top-level comment objects, each with 'author', 'comment', 'upvotes', and 'replies' keys. The 'replies' key contains a list of nested comment objects.\n\n"
-        f"Here are your personas: {personas}\n\n"
-        f"You should incorporate some of the following slang terms across many of the comments even if it is out of character in order to create a more realistic online environment: {YOUTH_SLANG} \n"
-        f"Remember, any persona can make a short comment. An 'Expert Analyst' isn't limited to long paragraphs; they can also make a cutting, one-phrase joke or observation.\n"
-        f"{post_content_prompt}"
-        f"CRITICAL INSTRUCTIONS & EXAMPLES \n"
-        f"You must follow TWO primary rules to create a realistic comment section:\n\n"
-        f"RULE 1: The Rule of Balance (CRITICAL: MINIMUM 40% SHORT-FORM). To ensure realistic variety, you MUST adhere to a specific mix. At least 40% of the total comments (including replies) MUST be 'short-form.' A short-form comment is strictly defined as UNDER 15 WORDS, often a single sentence, phrase, emoji-laden response, or even just a few words. These are the memes, the one-line zingers, quick reactions, and gut feelings. This balance is not optional.\n\n"
-        f"RULE 2: The Rule of Conversation. The primary goal is to simulate a conversation, not a list of disconnected statements. Therefore, you MUST create deep comment threads. At least 50% of the personas used MUST reply to another comment rather than creating a new top-level comment. A flat list of many top-level comments with no replies is a FAILED generation.\n\n"
-        f"All comments, regardless of length or depth, must demonstrate specific knowledge. They must talk as if they are true fans, critics, or experts who are deeply familiar with the subject. For very short comments, this 'knowledge' can be conveyed through specific slang, inside jokes, character/lore nicknames, or an informed, immediate emotional reaction that only a true fan would have. The persona's traits should COLOR their commentary, not REPLACE it.\n\n"
-        f"--- EXAMPLES OF GOOD COMMENT *CONTENT* ---\n"
-        f"For example, if the headline is 'One Punch Man Season 3: 6.5 Years Wait for Same Recycled Animation':\n\n"
-        f"GOOD (Detailed): \"author\": \"Prodigy_von_Ordelia\", \"comment\": \"Six and a half years for this? After the disaster of J.C. Staff's handling of S2, particularly the metal shine on Genos and the slideshow-level Garou fight, I expected a complete overhaul. To hear it's 'recycled animation' suggests they learned nothing. Unacceptable.\"\n"
-        f"GOOD (Short & Knowledgeable): \"author\": \"ChadThunderclap\", \"comment\": \"JC Staff and their damn metal shine, name a more iconic duo. I'll wait.\"\n"
-        f"BAD (Generic): \"author\": \"Prodigy_von_Ordelia\", \"comment\": \"A 6.5-year delay is unacceptable. Studios need to be held to a higher standard.\"\n\n"
-        f"--- EXAMPLE OF GOOD COMMENT *STRUCTURE* (Following the Rule of Conversation) ---\n"
-        f"This shows how personas should reply to each other in a nested thread:\n"
-        f"```json\n"
-        f"[\n"
-        f'  {{\n'
-        f'    "author": "PixelProwler",\n'
-        f'    "comment": "OMG, the particle effects on the sword are insane.",\n'
-        f'    "upvotes": 128,\n'
-        f'    "replies": [\n'
-        f'      {{\n'
-        f'        "author": "Prodigy_von_Ordelia",\n'
-        f'        "comment": "Incredible? The design is derivative of every dark fantasy trope from the last decade. The armor is impractical and the particle effects will just obscure the telegraphing for his attacks. It\'s style over substance.",\n'
-        f'        "upvotes": 45,\n'
-        f'        "replies": [\n'
-        f'          {{\n'
-        f'            "author": "ChadThunderclap",\n'
-        f'            "comment": "lol nerd. Big sword go brrrr.",\n'
-        f'            "upvotes": 250,\n'
-        f'            "replies": []\n'
-        f'          }}\n'
-        f'        ]\n'
-        f'      }}\n'
-        f'    ]\n'
-        f'  }}\n'
-        f']\n'
-        f"```\n"
-        f"END OF CRITICAL INSTRUCTIONS \n\n"
-        f"FINAL CHECKLIST BEFORE GENERATING \n"
-        f"- Conversational Depth: Does the output feel like a conversation? Are there multiple deep comment threads (2+ replies deep)? Did I follow the Rule of Conversation, ensuring at least half the personas are replying?\n"
-        f"- Comment Length Variety: Is there a healthy mix of long and short comments? Did I meet the 40% short-form rule (UNDER 15 WORDS)?\n"
-        f"- Knowledge Depth: Do even the shortest comments contain a specific reference, nickname, or piece of in-community knowledge?\n"
-        f"- Overall Vibe: Does this feel like a real, chaotic, and diverse fan forum, not just a collection of essays?\n\n"
-        f"Now, generate a full, nested comment section for the provided headline. Remember:\n"
-        f"- The diction should be reflective of modern brain rotted online communities heavily favoring short, fragmented sentences, single-phrase quips, slang, and emojis for many comments,** alongside longer, more detailed discussions.\n"
-        f"- Do not use markdown formatting in the final comment text.\n"
-        f"- Comment length should vary from short single phrase quips to multi-paragraph rants.\n"
-        f"- Do not simulate replies from the original post author. Only use the provided fictional personas.\n"
-        f"- The PRIMARY GOAL is to create conversation threads where personas react and reply to one another. A long list of un-replied, top-level comments is a failure.\n"
-        f"- Ensure the final output is only the JSON object."
-    )
-
-    api_contents.insert(0, reddit_prompt)
+def generate_reddit_comments(post_title, post_body, image_object, personas):
+    with metrics.stage("prompt_build"):
+        api_contents = build_prompt(post_title, post_body, image_object, personas, YOUTH_SLANG)
 
     print("--- Sending Prompt to AI ---")
 
-    response = client.generate_content(
-        contents=api_contents,
-        generation_config=types.GenerationConfig(
-            temperature=2.0,
-            top_p=0.95,
-            max_output_tokens=3000,
-            response_mime_type="application/json"))
+    generation_config = _import("google.generativeai").types.GenerationConfig(
+        temperature=2.0,
+        top_p=0.95,
+        max_output_tokens=COMMENT_MAX_OUTPUT_TOKENS,
+        response_mime_type="application/json")
 
-    reddit_data = repair_and_parse_json(response.text)
-
-    if reddit_data:
+    if STREAM_RESPONSES:
+        reddit_data, raw_text = stream_comments(api_contents, generation_config)
+    else:
+        with metrics.stage("gemini"):
+            response = call_gemini(api_contents, generation_config)
+            raw_text = response.text
+        count_gemini_usage(api_contents, raw_text, getattr(response, "usage_metadata", None))
+        with metrics.stage("json_parse"):
+            reddit_data = repair_and_parse_json(raw_text)
+
+    comments = finish_comment_section(reddit_data)
+    if comments:
         print("--- Successfully Parsed JSON Data ---")
-        return reddit_data
+        return comments
     else:
         print(f"\n--- Error: Failed to parse JSON, and repair attempt was unsuccessful. ---")
         print("Raw AI response was:")
-        print(response.text)
+        print(raw_text)
         return None
 
 
-def update_post_history(new_post):
+def collect_response(api_contents, generation_config):
+    chunks = []
+    usage = None
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        history = []
-
-    history.insert(0, new_post)
+        with metrics.stage("gemini"):
+            if STREAM_RESPONSES:
+                for chunk in call_gemini(api_contents, generation_config, stream=True):
+                    chunks.append(chunk.text)
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+            else:
+                response = call_gemini(api_contents, generation_config)
+                chunks.append(response.text)
+                usage = getattr(response, "usage_metadata", None)
+    except Exception as e:
+        if not chunks:
+            raise
+        print(f"--- Response stream broke off: {e}. Keeping what arrived. ---")
+        metrics.count("gemini_streams_broken")
+    return "".join(chunks), usage
+
+
+BATCH_SECTION_START = re.compile(r'"(post_\d+)"\s*:\s*\[')
+
+
+def split_batch_response(text, count):
+    # Every post's list is parsed on its own, so a malformed or cut-off section only costs that post
+    sections = [None] * count
+    for match in BATCH_SECTION_START.finditer(text):
+        key = match.group(1)
+        i = int(key[5:]) - 1
+        if not 0 <= i < count or sections[i] is not None:
+            continue
+        parser = CommentStreamParser()
+        parser.feed(text[match.end() - 1:])
+        comments = parser.result()
+        if not comments:
+            print(f"--- Comment section {key} could not be read ---")
+            continue
+        if not parser.done:
+            print(f"--- Comment section {key} was cut off, salvaged {len(comments)} top-level comments ---")
+            metrics.count("json_salvaged")
+        else:
+            metrics.count("json_batch_sections")
+        sections[i] = comments
+    missing = sum(section is None for section in sections)
+    if missing:
+        metrics.count("json_failed", missing)
+    return sections
+
+
+def generate_batch_comments(posts, personas):
+    with metrics.stage("prompt_build"):
+        api_contents = build_batch_prompt(posts, personas, YOUTH_SLANG)
+
+    print(f"--- Sending Prompt for {len(posts)} headlines to AI ---")
+
+    generation_config = _import("google.generativeai").types.GenerationConfig(
+        temperature=2.0,
+        top_p=0.95,
+        max_output_tokens=min(GEMINI_MAX_OUTPUT_TOKENS, COMMENT_MAX_OUTPUT_TOKENS * len(posts)),
+        response_mime_type="application/json")
+
+    raw_text, usage = collect_response(api_contents, generation_config)
+    count_gemini_usage(api_contents, raw_text, usage)
+    metrics.count("batched_requests")
+    with metrics.stage("json_parse"):
+        sections = split_batch_response(raw_text, len(posts))
+
+    sections = [finish_comment_section(section) if section else None for section in sections]
+    parsed = [section for section in sections if section]
+    print(f"--- Parsed {len(parsed)} of {len(posts)} comment sections ---")
+    if not parsed:
+        print("Raw AI response was:")
+        print(raw_text)
+    return sections
 
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(history, f, indent=2)
-    print(f"--- Post history updated. Total posts: {len(history)} ---")
-    return history
 
+def update_post_history(new_post):
+    post_history = get_post_history()
+    # Load the indexes before appending, otherwise one built now would already count the new post
+    seen_links = get_seen_links()
+    headline_index = get_headline_index()
+    post_history.append(new_post)
+    seen_links.add(new_post['headline'].get('link'))
+    headline_index.add(new_post['headline'].get('title'))
+    print(f"--- Post history updated. Total posts: {len(post_history)} ---")
+    return post_history
+
+
+# The renderer writes chunks through a write callable (a file's write, or a list's append) so the
+# page is never built up by repeated string concatenation.
+def write_comment(write, comment, depth=0):
+    # Explicit stack instead of recursion so deep reply chains can't hit the recursion limit;
+    # None marks where a comment's replies end.
+    stack = [(comment, depth)]
+    while stack:
+        comment, depth = stack.pop()
+        if comment is None:
+            write("</div></div>")
+            continue
 
-def format_comment(comment, depth=0):
-    author = comment.get('author', 'Anonymous')
-    comment_text = comment.get('comment', '[Message has been deleted by moderator]').replace('\n', '<br>')
-    upvotes = comment.get('upvotes', 1)
-    replies = comment.get('replies', [])
-    margin_left = f"margin-left: {depth * 5}px;"
+        author = html.escape(comment.author, quote=False)
+        comment_text = html.escape(comment.text, quote=False).replace('\n', '<br>')
+        upvotes = comment.upvotes
+        replies = comment.replies
+        margin_left = f"margin-left: {depth * 5}px;"
 
-    html = f"""
+        write(f"""
     <div class="comment" style="{margin_left}">
         <div class="comment-header">
             <span class="author">{author}</span>
@@ -538,52 +2449,34 @@ def format_comment(comment, depth=0):
             <p>{comment_text}</p>
         </div>
         <div class="replies">
-    """
+    """)
+        stack.append((None, depth))
+        stack.extend((reply, depth + 1) for reply in reversed(replies))
 
-    for reply in replies:
-        html += format_comment(reply, depth + 1)
-    html += "</div></div>"
 
-    return html
+def format_comment(comment, depth=0):
+    chunks = []
+    write_comment(chunks.append, comment, depth)
+    return "".join(chunks)
 
 
-def format_single_post_html(post_data, topic_id=None):
-    headline_title = post_data['headline']['title']
+def write_post_html(write, post_data, topic_id=None):
+    headline_title = html.escape(post_data['headline']['title'], quote=False)
     headline_link = post_data['headline']['link']
     post_body = post_data['headline'].get('body')
     generation_time = post_data['timestamp']
     comments_data = post_data['comments']
     topic_data_attribute = f"data-topic-id='topic-{topic_id}'" if topic_id is not None else ""
+    post_key = _post_key(post_data)
 
     body_preview_html = ""
     if post_body:
         if len(post_body) > 100:
             preview_text = (post_body[:400] + '...') if len(post_body) > 400 else post_body
-            body_preview_html = f'<div class="post-body-preview"><p>{preview_text.replace(chr(10), "<br>")}</p></div>'
-
-    comments_html = ""
-    if comments_data:
-        if len(comments_data) > 0:
-            first_comment = comments_data[0]
-            comments_html += format_comment(first_comment)
-
-            if len(comments_data) > 1:
-                rest_of_comments = comments_data[1:]
-
-                comments_html += f"""
-                <button class="toggle-comments-btn" onclick="toggleComments(this)">
-                    Show {len(rest_of_comments)} More Comments
-                </button>
-                """
-
-                rest_of_comments_html = ""
-                for comment in rest_of_comments:
-                    rest_of_comments_html += format_comment(comment)
-
-                comments_html += f'<div class="collapsible-comments collapsed">{rest_of_comments_html}</div>'
+            body_preview_html = f'<div class="post-body-preview"><p>{html.escape(preview_text, quote=False).replace(chr(10), "<br>")}</p></div>'
 
-    return f"""
-        <div class="post-container" {topic_data_attribute}>
+    write(f"""
+        <div class="post-container" data-post-key="{post_key}" {topic_data_attribute}>
             <div class="headline">
                 <h2><a href="{headline_link}" target="_blank">{headline_title}</a></h2>
             </div>
@@ -593,80 +2486,498 @@ def format_single_post_html(post_data, topic_id=None):
             </div>
             <hr class="post-divider">
             <div class="comments-section">
-                {comments_html if comments_html else "<p style='color: #818384; font-style: italic;'>No comments yet.</p>"}
+                """)
+
+    if comments_data:
+        write_comment(write, comments_data[0])
+
+        if len(comments_data) > 1:
+            rest_of_comments = comments_data[1:]
+
+            write(f"""
+                <button class="toggle-comments-btn" onclick="toggleComments(this)">
+                    Show {len(rest_of_comments)} More Comments
+                </button>
+                """)
+
+            write('<div class="collapsible-comments collapsed">')
+            for comment in rest_of_comments:
+                write_comment(write, comment)
+            write('</div>')
+    else:
+        write("<p style='color: #818384; font-style: italic;'>No comments yet.</p>")
+
+    write("""
             </div>
         </div>
-        """
+        """)
 
-def get_trending_topics(posts_to_analyze):
-    if not posts_to_analyze:
-        return []
-
-    print(f"\n--- Clustering {len(posts_to_analyze)} headlines to find topics ---")
-    headline_titles = [post['headline']['title'] for post in posts_to_analyze]
-    headline_embeddings = embedding_model.encode(headline_titles, convert_to_tensor=False)
 
-    clustering = AgglomerativeClustering(n_clusters=None, distance_threshold=1.5)
-    clustering.fit(headline_embeddings)
+def format_single_post_html(post_data, topic_id=None):
+    chunks = []
+    write_post_html(chunks.append, post_data, topic_id)
+    return "".join(chunks)
+
+
+# Rendered post HTML on disk, keyed by link, topic id and a hash of the post content, so a render
+# only has to build the posts that are new or changed.
+class FragmentCache:
+    def __init__(self, directory=FRAGMENT_CACHE_DIR):
+        self.directory = directory
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(post, topic_id):
+        digest = hashlib.sha1(f"{FRAGMENT_CACHE_VERSION}|{post['headline'].get('link')}|{topic_id}|".encode('utf-8'))
+        digest.update(json.dumps(post, sort_keys=True, default=json_default).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, post, topic_id):
+        key = self.key(post, topic_id)
+        self.used.add(key)
+        path = os.path.join(self.directory, key + ".html")
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                fragment = f.read()
+            self.hits += 1
+            return fragment
+        except FileNotFoundError:
+            pass
+
+        fragment = format_single_post_html(post, topic_id)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + ".tmp", 'w', encoding='utf-8', newline='') as f:
+            f.write(fragment)
+        os.replace(path + ".tmp", path)
+        self.misses += 1
+        return fragment
+
+    def prune(self):
+        # Drop fragments the last render didn't use and reset the counters for the next one
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".html") and name[:-5] not in self.used:
+                    os.remove(os.path.join(self.directory, name))
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+
+fragment_cache = FragmentCache()
+
+
+def get_trending_topics(posts_to_analyze, history=None):
+    if not posts_to_analyze:
+        return [], {}
 
-    clusters = {}
-    post_to_cluster_map = {i: label for i, label in enumerate(clustering.labels_)}
+    with metrics.stage("topics"):
+        return _trending_topics(posts_to_analyze, history)
 
-    for i, label in enumerate(clustering.labels_):
-        if label not in clusters:
-            clusters[label] = []
-        clusters[label].append(i)
 
-    trending_topics = []
-    for label, indices in clusters.items():
-        if len(indices) > 1:
-            cluster_embeddings = headline_embeddings[np.array(indices)]
-            centroid = np.mean(cluster_embeddings, axis=0)
+def _trending_topics(posts_to_analyze, history):
+    topic_index = get_topic_index()
 
-            similarities = cosine_similarity(cluster_embeddings, [centroid])
-            most_representative_index_in_cluster = np.argmax(similarities)
-            original_post_index = indices[most_representative_index_in_cluster]
+    # Topic counts live in the topic index, so only a fresh index needs to see the whole history
+    if history is not None and not topic_index.assignments:
+        print("\n--- Building topic index from the full post history ---")
+        topic_index.assign(list(history.titles()))  # oldest first, so the newest end up in the re-cluster window
 
-            topic_name = headline_titles[original_post_index]
-            topic_size = len(indices)
-            trending_topics.append({"name": topic_name, "count": topic_size, "id": label})
+    print(f"\n--- Clustering {len(posts_to_analyze)} headlines to find topics ---")
+    headline_titles = [post['headline']['title'] for post in posts_to_analyze]
+    topic_ids = topic_index.assign(headline_titles)
+    post_to_cluster_map = dict(enumerate(topic_ids))
 
-    sorted_topics = sorted(trending_topics, key=lambda x: x['count'], reverse=True)
+    sorted_topics = sorted(topic_index.trending(), key=lambda x: x['count'], reverse=True)
     print(f"--- Found {len(sorted_topics)} trending topics. ---")
     return sorted_topics, post_to_cluster_map
 
 
-def generate_feed_html(posts, full_post_history):
-    trending_topics, post_to_cluster_map = get_trending_topics(full_post_history)
+# Page scripts, split so the client-rendered shell can share the topic list handling
+FEED_SCRIPT_TOGGLE_COMMENTS = """            function toggleComments(button) {
+                const collapsibleSection = button.nextElementSibling;
+                if (collapsibleSection) {
+                    collapsibleSection.classList.toggle('collapsed');
+                    const isCollapsed = collapsibleSection.classList.contains('collapsed');
+                    if (isCollapsed) {
+                        const commentCount = collapsibleSection.children.length;
+                        button.textContent = `Show ${commentCount} More Comments`;
+                    } else {
+                        button.textContent = 'Hide Comments';
+                    }
+                }
+            }
 
-    all_posts_html = ""
-    for i, post in enumerate(posts):
-        topic_id = post_to_cluster_map.get(i)
-        all_posts_html += format_single_post_html(post, topic_id)
+"""
+FEED_SCRIPT_TOPIC_LIST = """            function toggleTopicList(header) {
+                const content = header.nextElementSibling;
+                const isCollapsed = content.classList.toggle('collapsed');
+                if (isCollapsed) {
+                    header.innerHTML = 'Post Clusters &#9662;'; // Down arrow
+                } else {
+                    header.innerHTML = 'Post Clusters &#9652;'; // Up arrow
+                }
+            }
 
-    trending_list_html = "<ul>"
-    trending_list_html += '<li><a href="#" class="topic-link" onclick="showAllPosts(event)"><strong>Show All Posts</strong></a></li>'
-    if trending_topics:
-        for topic in trending_topics:
-            trending_list_html += f"""
-                <li>
-                    <a href="#" class="topic-link" onclick="filterByTopic('topic-{topic['id']}', event)">
-                        "{topic['name']}" ({topic['count']} posts)
-                    </a>
-                </li>
-            """
-    else:
-        trending_list_html += "<li>No trending topics yet.</li>"
-    trending_list_html += "</ul>"
+            function setActiveLink(clickedElement) {
+                document.querySelectorAll('.topic-link').forEach(link => {
+                    link.classList.remove('active');
+                });
+                if (clickedElement) {
+                    clickedElement.classList.add('active');
+                }
+            }
 
-    trending_html = f"""
-        <h3 class="collapsible-header" onclick="toggleTopicList(this)">Post Clusters &#9662;</h3>
-        <div id="topic-list-content" class="collapsible-content collapsed">
-            {trending_list_html}
-        </div>
-    """
+            function collapseTopicList() {
+                const topicListContent = document.getElementById('topic-list-content');
+                const topicListHeader = topicListContent.previousElementSibling; // This gets the <h3>
+                if (!topicListContent.classList.contains('collapsed')) {
+                    topicListContent.classList.add('collapsed');
+                    topicListHeader.innerHTML = 'Post Clusters &#9662;';
+                }
+            }
+
+"""
+FEED_SCRIPT_DOM_FILTER = """            function filterByTopic(topicId, event) {
+                event.preventDefault(); 
+                setActiveLink(event.currentTarget);
+                const allPosts = document.querySelectorAll('.post-container');
+                allPosts.forEach(post => {
+                    if (post.dataset.topicId === topicId) {
+                        post.style.display = 'block';
+                    } else {
+                        post.style.display = 'none';
+                    }
+                });
+                collapseTopicList();
+            }
 
-    html_template = f"""
+            function showAllPosts(event) {
+                event.preventDefault(); 
+                setActiveLink(event.currentTarget);
+                const allPosts = document.querySelectorAll('.post-container');
+                allPosts.forEach(post => {
+                    post.style.display = 'block';
+                });
+                collapseTopicList(); // MODIFICATION: Collapse list after clicking "Show All"
+            }
+
+            function filterByKeys(keys) {
+                document.querySelectorAll('.post-container').forEach(post => {
+                    post.style.display = !keys || keys.has(post.dataset.postKey) ? 'block' : 'none';
+                });
+            }
+"""
+# Queries the static search index: loads the manifest once, then only the term shards the query's
+# terms fall in and the doc files of the top results. Every term has to match; the last one also
+# matches as a prefix so results follow along while it is typed. Matching posts on the page are
+# filtered like a topic, and the best matches across the whole history are listed with their links.
+FEED_SCRIPT_SEARCH = """
+            const SEARCH_RESULTS = 50;
+            const searchFiles = new Map();
+            let searchTimer = null;
+
+            function loadSearchFile(path) {
+                if (!searchFiles.has(path)) {
+                    const directory = document.getElementById('search-form').dataset.index;
+                    searchFiles.set(path, fetch(`${directory}/${path}`)
+                        .then(response => response.ok ? response.json() : null)
+                        .catch(() => null));
+                }
+                return searchFiles.get(path);
+            }
+
+            function searchShard(term) {
+                return /^[a-z0-9]{2}/.test(term) ? term.slice(0, 2) : '_';
+            }
+
+            async function searchPosts(query) {
+                const manifest = await loadSearchFile('manifest.json');
+                if (!manifest) return null;
+                const stopWords = new Set(manifest.stop_words);
+                const terms = [...new Set((query.toLowerCase().match(/[\\p{L}\\p{N}]+/gu) || []).filter(term =>
+                    term.length >= manifest.min_term_length && term.length <= manifest.max_term_length && !stopWords.has(term)))];
+                if (!terms.length) return null;
+
+                const shards = await Promise.all(terms.map(term => manifest.shards.includes(searchShard(term))
+                    ? loadSearchFile(`terms/${searchShard(term)}.json`) : null));
+                let scores = null;
+                terms.forEach((term, i) => {
+                    const shard = shards[i] || {};
+                    const matching = i === terms.length - 1
+                        ? Object.keys(shard).filter(key => key.startsWith(term))
+                        : (Object.hasOwn(shard, term) ? [term] : []);
+                    const termScores = new Map();
+                    matching.forEach(key => {
+                        const postings = shard[key];
+                        let doc = 0;
+                        for (let j = 0; j < postings.length; j += 2) {
+                            doc += postings[j];
+                            termScores.set(doc, (termScores.get(doc) || 0) + postings[j + 1]);
+                        }
+                    });
+                    if (scores === null) {
+                        scores = termScores;
+                    } else {
+                        const both = new Map();
+                        scores.forEach((score, doc) => {
+                            if (termScores.has(doc)) both.set(doc, score + termScores.get(doc));
+                        });
+                        scores = both;
+                    }
+                });
+
+                // Best score first, newer posts first among equals
+                const ranked = [...scores].sort((a, b) => b[1] - a[1] || b[0] - a[0]);
+                const top = ranked.slice(0, SEARCH_RESULTS);
+                // The newest doc files are loaded too, they hold the posts shown on the page
+                const perFile = manifest.docs_per_file;
+                const lastFile = Math.floor((manifest.docs - 1) / perFile);
+                const numbers = [...new Set(top.map(([doc]) => Math.floor(doc / perFile)).concat([lastFile, lastFile - 1]))]
+                    .filter(n => n >= 0);
+                const files = new Map(await Promise.all(numbers.map(async n => [n, await loadSearchFile(`docs/${n}.json`)])));
+                const docEntry = doc => (files.get(Math.floor(doc / perFile)) || [])[doc % perFile];
+                const posts = top.map(([doc]) => docEntry(doc)).filter(Boolean)
+                    .map(([key, title, link, time]) => ({ key, title, link, time }));
+                const keys = new Set(ranked.map(([doc]) => docEntry(doc)).filter(Boolean).map(([key]) => key));
+                return { total: ranked.length, posts, keys };
+            }
+
+            function renderSearchResults(query, results) {
+                const container = document.getElementById('search-results');
+                container.replaceChildren();
+                if (!results) return;
+                const summary = document.createElement('p');
+                summary.textContent = results.total
+                    ? `${results.total} posts match "${query}"` + (results.total > results.posts.length ? `, showing the best ${results.posts.length}` : '')
+                    : `No posts match "${query}"`;
+                container.appendChild(summary);
+                const list = document.createElement('ul');
+                results.posts.forEach(post => {
+                    const item = document.createElement('li');
+                    const link = document.createElement('a');
+                    link.href = post.link;
+                    link.target = '_blank';
+                    link.textContent = post.title;
+                    const time = document.createElement('span');
+                    time.className = 'search-time';
+                    time.textContent = ` ${post.time}`;
+                    item.append(link, time);
+                    list.appendChild(item);
+                });
+                container.appendChild(list);
+            }
+
+            async function runSearch(event) {
+                if (event) event.preventDefault();
+                const input = document.getElementById('search-input');
+                const query = input.value.trim();
+                const results = await searchPosts(query);
+                if (input.value.trim() !== query) return; // A newer search is on its way
+                setActiveLink(null);
+                filterByKeys(results ? results.keys : null);
+                renderSearchResults(query, results);
+            }
+
+            document.addEventListener('DOMContentLoaded', () => {
+                const input = document.getElementById('search-input');
+                if (!input) return;
+                input.addEventListener('input', () => {
+                    clearTimeout(searchTimer);
+                    searchTimer = setTimeout(runSearch, 200);
+                });
+            });
+"""
+STATIC_FEED_SCRIPT = ("        <script>\n" + FEED_SCRIPT_TOGGLE_COMMENTS + FEED_SCRIPT_TOPIC_LIST + FEED_SCRIPT_DOM_FILTER
+                      + FEED_SCRIPT_SEARCH + "        </script>")
+# Loads data/index.json (key and topic of every post, in feed order) up front and renders posts a
+# batch at a time as the end of the list scrolls into view, fetching the data/pages/ chunk that holds
+# them on first use. A post's remaining comments come from data/comments/ the first time they are
+# expanded. Filters work on the index, so only the pages of matching posts are ever fetched.
+FEED_SCRIPT_CLIENT = """            const RENDER_BATCH = 10;
+            let feedIndex = { page_size: 1, posts: [] };
+            const pages = new Map();
+            let visiblePosts = [];
+            let renderedCount = 0;
+            let rendering = false;
+            let generation = 0;
+            let feedEndObserver = null;
+
+            function element(tag, className, text) {
+                const node = document.createElement(tag);
+                if (className) node.className = className;
+                if (text !== undefined) node.textContent = text;
+                return node;
+            }
+
+            function paragraph(text) {
+                const p = element('p');
+                text.split('\\n').forEach((line, i) => {
+                    if (i) p.appendChild(element('br'));
+                    p.appendChild(document.createTextNode(line));
+                });
+                return p;
+            }
+
+            function renderComment(comment, depth) {
+                const root = element('div', 'comment');
+                root.style.marginLeft = `${depth * 5}px`;
+                const header = element('div', 'comment-header');
+                header.appendChild(element('span', 'author', String(comment.author ?? 'Anonymous')));
+                header.appendChild(element('span', 'upvotes', `${comment.upvotes ?? 1} points`));
+                const body = element('div', 'comment-body');
+                body.appendChild(paragraph(String(comment.comment ?? '[Message has been deleted by moderator]')));
+                const replies = element('div', 'replies');
+                (comment.replies || []).forEach(reply => replies.appendChild(renderComment(reply, depth + 1)));
+                root.append(header, body, replies);
+                return root;
+            }
+
+            function renderPost(post) {
+                const container = element('div', 'post-container');
+                if (post.topic !== null) container.dataset.topicId = `topic-${post.topic}`;
+                const headline = element('div', 'headline');
+                const h2 = element('h2');
+                const link = element('a', '', post.title);
+                link.href = post.link;
+                link.target = '_blank';
+                h2.appendChild(link);
+                headline.appendChild(h2);
+                container.appendChild(headline);
+                if (post.body) {
+                    const preview = element('div', 'post-body-preview');
+                    preview.appendChild(paragraph(post.body));
+                    container.appendChild(preview);
+                }
+                const timestamp = element('div', 'timestamp');
+                timestamp.appendChild(element('p', '', `Posted on: ${post.time}`));
+                container.append(timestamp, element('hr', 'post-divider'));
+                const comments = element('div', 'comments-section');
+                if (post.first) comments.appendChild(renderComment(post.first, 0));
+                if (post.more) {
+                    const button = element('button', 'toggle-comments-btn', `Show ${post.more} More Comments`);
+                    button.dataset.key = post.key;
+                    button.onclick = () => toggleComments(button);
+                    comments.append(button, element('div', 'collapsible-comments collapsed'));
+                }
+                container.appendChild(comments);
+                return container;
+            }
+
+            function loadPage(number) {
+                if (!pages.has(number)) {
+                    pages.set(number, fetch(`data/pages/${number}.json`).then(response => response.json()));
+                }
+                return pages.get(number);
+            }
+
+            async function postAt(position) {
+                const page = await loadPage(Math.floor(position / feedIndex.page_size));
+                return page[position % feedIndex.page_size];
+            }
+
+            function watchFeedEnd() {
+                // Observing again reports the current state, so batches keep coming while the end is on screen
+                const end = document.getElementById('feed-end');
+                feedEndObserver.unobserve(end);
+                feedEndObserver.observe(end);
+            }
+
+            async function renderMore() {
+                if (rendering || renderedCount >= visiblePosts.length) return;
+                rendering = true;
+                const current = generation;
+                const batch = visiblePosts.slice(renderedCount, renderedCount + RENDER_BATCH);
+                try {
+                    const posts = await Promise.all(batch.map(postAt));
+                    if (current === generation) {
+                        const main = document.getElementById('posts');
+                        posts.forEach(post => main.appendChild(renderPost(post)));
+                        renderedCount += batch.length;
+                    }
+                } finally {
+                    rendering = false;
+                }
+                // A filter picked while the pages were loading gets its first batch now
+                if (current !== generation) renderMore();
+                else if (feedEndObserver) watchFeedEnd();
+            }
+
+            function showPosts(positions) {
+                generation++;
+                document.getElementById('posts').replaceChildren();
+                visiblePosts = positions;
+                renderedCount = 0;
+                return renderMore();
+            }
+
+            function matchingPosts(test) {
+                const positions = [];
+                feedIndex.posts.forEach(([key, topic], position) => {
+                    if (test(key, topic)) positions.push(position);
+                });
+                return positions;
+            }
+
+            async function toggleComments(button) {
+                const collapsibleSection = button.nextElementSibling;
+                if (!collapsibleSection.dataset.loaded) {
+                    button.disabled = true;
+                    try {
+                        const response = await fetch(`data/comments/${button.dataset.key}.json`);
+                        const comments = await response.json();
+                        comments.forEach(comment => collapsibleSection.appendChild(renderComment(comment, 0)));
+                        collapsibleSection.dataset.loaded = 'true';
+                    } finally {
+                        button.disabled = false;
+                    }
+                }
+                const isCollapsed = collapsibleSection.classList.toggle('collapsed');
+                button.textContent = isCollapsed ? `Show ${collapsibleSection.children.length} More Comments` : 'Hide Comments';
+            }
+
+            function filterByTopic(topicId, event) {
+                event.preventDefault();
+                setActiveLink(event.currentTarget);
+                showPosts(matchingPosts((key, topic) => topic !== null && `topic-${topic}` === topicId));
+                collapseTopicList();
+            }
+
+            function showAllPosts(event) {
+                event.preventDefault();
+                setActiveLink(event.currentTarget);
+                showPosts(matchingPosts(() => true));
+                collapseTopicList();
+            }
+
+            function filterByKeys(keys) {
+                showPosts(matchingPosts(key => !keys || keys.has(key)));
+            }
+
+            document.addEventListener('DOMContentLoaded', async () => {
+                const response = await fetch('data/index.json');
+                feedIndex = await response.json();
+                feedEndObserver = new IntersectionObserver(entries => {
+                    if (entries.some(entry => entry.isIntersecting)) renderMore();
+                }, { rootMargin: '1000px' });
+                showPosts(matchingPosts(() => true));
+            });
+"""
+CLIENT_FEED_SCRIPT = "        <script>\n" + FEED_SCRIPT_TOPIC_LIST + FEED_SCRIPT_CLIENT + FEED_SCRIPT_SEARCH + "        </script>"
+
+
+def search_form_html():
+    if not SEARCH_INDEX_DIR:
+        return ""
+    return f"""<form id="search-form" class="search-form" data-index="{html.escape(SEARCH_INDEX_DIR)}" onsubmit="runSearch(event)">
+                <input type="search" id="search-input" placeholder="Search headlines, comments and personas" aria-label="Search">
+            </form>
+            <div id="search-results" class="search-results"></div>"""
+
+
+def feed_html_head(trending_html, summary, script=STATIC_FEED_SCRIPT):
+    return f"""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -724,143 +3035,657 @@ def generate_feed_html(posts, full_post_history):
             .toggle-comments-btn {{ background-color: transparent; border: 1px solid #343536; color: #818384; padding: 5px 10px; margin-top: 15px; margin-left: 15px; border-radius: 4px; cursor: pointer; font-size: 0.8em; font-weight: bold; }}
             .toggle-comments-btn:hover {{ border-color: #818384; color: #d7dadc; }}
             .collapsible-comments.collapsed, .collapsible-content.collapsed {{ display: none; }} /* Consolidated the collapsed style */
+            .pagination {{ text-align: center; color: #818384; margin-bottom: 30px; }}
+            .pagination a {{ color: #a6cbe7; text-decoration: none; margin: 0 15px; }}
+            .pagination a:hover {{ text-decoration: underline; }}
+            .search-form input {{ width: 100%; box-sizing: border-box; padding: 10px; background-color: #1a1a1b; border: 1px solid #343536; border-radius: 8px; color: #d7dadc; font-size: 1em; }}
+            .search-results {{ margin: 10px 0 30px; color: #818384; }}
+            .search-results ul {{ padding-left: 0; list-style-type: none; }}
+            .search-results li {{ margin-bottom: 8px; }}
+            .search-results a {{ color: #a6cbe7; text-decoration: none; }}
+            .search-results a:hover {{ text-decoration: underline; }}
+            .search-time {{ font-size: 0.8em; }}
         </style>
-        <script>
-            function toggleComments(button) {{
-                const collapsibleSection = button.nextElementSibling;
-                if (collapsibleSection) {{
-                    collapsibleSection.classList.toggle('collapsed');
-                    const isCollapsed = collapsibleSection.classList.contains('collapsed');
-                    if (isCollapsed) {{
-                        const commentCount = collapsibleSection.children.length;
-                        button.textContent = `Show ${{commentCount}} More Comments`;
-                    }} else {{
-                        button.textContent = 'Hide Comments';
-                    }}
-                }}
-            }}
-
-            function toggleTopicList(header) {{
-                const content = header.nextElementSibling;
-                const isCollapsed = content.classList.toggle('collapsed');
-                if (isCollapsed) {{
-                    header.innerHTML = 'Post Clusters &#9662;'; // Down arrow
-                }} else {{
-                    header.innerHTML = 'Post Clusters &#9652;'; // Up arrow
-                }}
-            }}
-
-            function setActiveLink(clickedElement) {{
-                document.querySelectorAll('.topic-link').forEach(link => {{
-                    link.classList.remove('active');
-                }});
-                if (clickedElement) {{
-                    clickedElement.classList.add('active');
-                }}
-            }}
-
-            function collapseTopicList() {{
-                const topicListContent = document.getElementById('topic-list-content');
-                const topicListHeader = topicListContent.previousElementSibling; // This gets the <h3>
-                if (!topicListContent.classList.contains('collapsed')) {{
-                    topicListContent.classList.add('collapsed');
-                    topicListHeader.innerHTML = 'Post Clusters &#9662;';
-                }}
-            }}
-
-            function filterByTopic(topicId, event) {{
-                event.preventDefault(); 
-                setActiveLink(event.currentTarget);
-                const allPosts = document.querySelectorAll('.post-container');
-                allPosts.forEach(post => {{
-                    if (post.dataset.topicId === topicId) {{
-                        post.style.display = 'block';
-                    }} else {{
-                        post.style.display = 'none';
-                    }}
-                }});
-                collapseTopicList();
-            }}
-
-            function showAllPosts(event) {{
-                event.preventDefault(); 
-                setActiveLink(event.currentTarget);
-                const allPosts = document.querySelectorAll('.post-container');
-                allPosts.forEach(post => {{
-                    post.style.display = 'block';
-                }});
-                collapseTopicList(); // MODIFICATION: Collapse list after clicking "Show All"
-            }}
-        </script>
+{script}
     </head>
     <body>
         <div class="page-header">
             <h1>Clankernet</h1>
-            <p>Displaying the {len(posts)} most recent posts.</p>
+            <p>{summary}</p>
         </div>
         <div class="content-area">
+            {search_form_html()}
             <div class="trending-topics-container">
                 {trending_html}
             </div>
             <div class="main-content">
-                {all_posts_html}
+                """
+
+
+FEED_HTML_TAIL = """
             </div>
         </div>
     </body>
     </html>
     """
-    with open("index.html", "w", encoding="utf-8") as f:
-        f.write(html_template)
-    print("--- index.html file generated successfully! ---")
 
 
-if __name__ == "__main__":
+def _page_filename(page_number):
+    return "index.html" if page_number == 1 else f"page-{page_number}.html"
+
+
+def _output_path(*parts):
+    return os.path.join(OUTPUT_DIR, *parts)
+
+
+def _paginate(posts):
+    # (index of the first post, posts) for every page; a single page unless POSTS_PER_PAGE is set
+    if not POSTS_PER_PAGE or len(posts) <= POSTS_PER_PAGE:
+        return [(0, posts)]
+    return [(start, posts[start:start + POSTS_PER_PAGE]) for start in range(0, len(posts), POSTS_PER_PAGE)]
+
+
+def _pager_html(page_number, page_count):
+    links = []
+    if page_number > 1:
+        links.append(f'<a href="{_page_filename(page_number - 1)}">&larr; Newer</a>')
+    links.append(f"<span>Page {page_number} of {page_count}</span>")
+    if page_number < page_count:
+        links.append(f'<a href="{_page_filename(page_number + 1)}">Older &rarr;</a>')
+    return f'<div class="pagination">{"".join(links)}</div>'
+
+
+def _remove_stale_pages(page_count):
+    for name in os.listdir(OUTPUT_DIR):
+        match = re.fullmatch(r"page-(\d+)\.html", name)
+        if match and int(match.group(1)) > page_count:
+            os.remove(_output_path(name))
+
+
+def trending_topics_html(trending_topics):
+    trending_list = ["<ul>"]
+    trending_list.append('<li><a href="#" class="topic-link" onclick="showAllPosts(event)"><strong>Show All Posts</strong></a></li>')
+    if trending_topics:
+        for topic in trending_topics:
+            trending_list.append(f"""
+                <li>
+                    <a href="#" class="topic-link" onclick="filterByTopic('topic-{topic['id']}', event)">
+                        "{html.escape(topic['name'], quote=False)}" ({topic['count']} posts)
+                    </a>
+                </li>
+            """)
+    else:
+        trending_list.append("<li>No trending topics yet.</li>")
+    trending_list.append("</ul>")
+    trending_list_html = "".join(trending_list)
+
+    return f"""
+        <h3 class="collapsible-header" onclick="toggleTopicList(this)">Post Clusters &#9662;</h3>
+        <div id="topic-list-content" class="collapsible-content collapsed">
+            {trending_list_html}
+        </div>
+    """
+
+
+def _post_key(post):
+    headline = post['headline']
+    return hashlib.sha1(f"{headline.get('link')}|{headline.get('title')}|{post.get('timestamp')}".encode('utf-8')).hexdigest()[:16]
+
+
+def client_post_summary(post, key, topic_id):
+    # Everything a post card shows before its collapsed comments are expanded
+    post_body = post['headline'].get('body')
+    preview = ""
+    if post_body and len(post_body) > 100:
+        preview = (post_body[:400] + '...') if len(post_body) > 400 else post_body
+    comments = post['comments'] or []
+    return {
+        "key": key,
+        "title": post['headline']['title'],
+        "link": post['headline']['link'],
+        "body": preview,
+        "time": post['timestamp'],
+        "topic": topic_id,
+        "first": comments[0] if comments else None,
+        "more": max(0, len(comments) - 1)
+    }
+
+
+def write_json_compact(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        # json.dumps goes through the C encoder, json.dump streams through the much slower Python one
+        f.write(json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=json_default))
+    os.replace(tmp_path, path)
+
+
+def write_client_feed(posts, trending_html, post_to_cluster_map):
+    comments_dir = _output_path(CLIENT_DATA_DIR, "comments")
+    pages_dir = _output_path(CLIENT_DATA_DIR, "pages")
+    os.makedirs(comments_dir, exist_ok=True)
+    os.makedirs(pages_dir, exist_ok=True)
+    feed_index = []
+    summaries = []
+    keys = set()
+    written = 0
+    for i, post in enumerate(posts):
+        key = _post_key(post)
+        topic_id = post_to_cluster_map.get(i)
+        keys.add(key)
+        feed_index.append([key, topic_id])
+        summaries.append(client_post_summary(post, key, topic_id))
+        # Posts never change once generated, so a chunk that exists is already up to date
+        path = os.path.join(comments_dir, key + ".json")
+        if len(post['comments'] or []) > 1 and not os.path.exists(path):
+            write_json_compact(path, post['comments'][1:])
+            written += 1
+    for name in os.listdir(comments_dir):
+        if name.endswith(".json") and name[:-5] not in keys:
+            os.remove(os.path.join(comments_dir, name))
+
+    # Every post moves down a place when one is added, so the pages are all rewritten
+    page_size = max(1, CLIENT_PAGE_POSTS)
+    page_count = (len(summaries) + page_size - 1) // page_size
+    for number in range(page_count):
+        write_json_compact(os.path.join(pages_dir, f"{number}.json"), summaries[number * page_size:(number + 1) * page_size])
+    for name in os.listdir(pages_dir):
+        match = re.fullmatch(r"(\d+)\.json", name)
+        if match and int(match.group(1)) >= page_count:
+            os.remove(os.path.join(pages_dir, name))
+    index_path = _output_path(CLIENT_DATA_DIR, "index.json")
+    write_json_compact(index_path, {"page_size": page_size, "posts": feed_index})
+
+    summary = f"Displaying the {len(posts)} most recent posts."
+    with open(_output_path("index.html"), "w", encoding="utf-8") as f:
+        f.write(feed_html_head(trending_html, summary, CLIENT_FEED_SCRIPT))
+        f.write('<div id="posts"></div><div id="feed-end"></div>')
+        f.write(FEED_HTML_TAIL)
+    _remove_stale_pages(1)
+    metrics.count("render_bytes", os.path.getsize(_output_path("index.html")) + os.path.getsize(index_path))
+    print(f"--- Wrote client-rendered feed: {len(summaries)} posts in {page_count} pages, {written} new comment chunks ---")
+
+
+SEARCH_TERM = re.compile(r"[^\W_]+")
+
+
+def search_terms(text):
+    return [term for term in SEARCH_TERM.findall(text.lower())
+            if SEARCH_MIN_TERM_LENGTH <= len(term) <= SEARCH_MAX_TERM_LENGTH and term not in SEARCH_STOP_WORDS]
+
+
+def search_shard(term):
+    # Terms are sharded by their first two characters; everything outside a-z0-9 shares one shard
+    prefix = term[:2]
+    return prefix if prefix.isascii() else "_"
+
+
+def post_search_weights(post):
+    weights = {}
+
+    def add(text, weight):
+        for term in search_terms(text):
+            weights[term] = weights.get(term, 0) + weight
+
+    add(post['headline'].get('title') or "", SEARCH_FIELD_WEIGHTS["title"])
+    add(post['headline'].get('body') or "", SEARCH_FIELD_WEIGHTS["body"])
+    stack = list(post['comments'])
+    while stack:
+        comment = stack.pop()
+        add(comment.text, SEARCH_FIELD_WEIGHTS["comment"])
+        add(comment.author, SEARCH_FIELD_WEIGHTS["author"])
+        stack.extend(comment.replies)
+    return weights
+
+
+# Inverted index over every post in the history, written as static JSON the page queries without
+# loading the corpus. manifest.json lists the shards; terms/<prefix>.json maps each term to its
+# postings as alternating doc id gaps and weights; docs/<n>.json holds the key, title, link and time
+# of SEARCH_DOCS_PER_FILE posts. Doc ids follow the history's append order, so new posts only extend
+# postings and an update rewrites just the shards their terms fall in. Postings at or below a term's
+# last doc id are skipped, so rerunning after a crash before the manifest was written is harmless.
+class SearchIndex:
+    def __init__(self, history, directory=SEARCH_INDEX_DIR):
+        self.history = history
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = None
+        if (manifest and manifest.get("version") == SEARCH_INDEX_VERSION
+                and manifest.get("docs_per_file") == SEARCH_DOCS_PER_FILE
+                and self.history.count_through(manifest["last_id"]) == manifest["docs"]):
+            return manifest
+        if manifest:
+            print("--- Search index does not match the post history, rebuilding ---")
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        return {"version": SEARCH_INDEX_VERSION, "docs": 0, "last_id": 0, "docs_per_file": SEARCH_DOCS_PER_FILE,
+                "min_term_length": SEARCH_MIN_TERM_LENGTH, "max_term_length": SEARCH_MAX_TERM_LENGTH,
+                "stop_words": sorted(SEARCH_STOP_WORDS), "shards": []}
+
+    def _read(self, path, default):
+        try:
+            with open(os.path.join(self.directory, path), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def _write(self, path, data):
+        path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_compact(path, data)
+
+    def update(self):
+        manifest = self._load_manifest()
+        doc = manifest["docs"]
+        shards = {}
+        docs = {}
+        for row_id, post in self.history.since(manifest["last_id"]):
+            for term, weight in post_search_weights(post).items():
+                shards.setdefault(search_shard(term), {}).setdefault(term, []).append((doc, weight))
+            headline = post['headline']
+            docs.setdefault(doc // SEARCH_DOCS_PER_FILE, []).append(
+                (doc % SEARCH_DOCS_PER_FILE, [_post_key(post), headline.get('title'), headline.get('link'), post.get('timestamp')]))
+            doc += 1
+            manifest["last_id"] = row_id
+        if doc == manifest["docs"]:
+            return 0
+
+        for shard, terms in shards.items():
+            path = f"terms/{shard}.json"
+            existing = self._read(path, {})
+            for term, postings in terms.items():
+                encoded = existing.setdefault(term, [])
+                last = sum(encoded[::2]) if encoded else None
+                for posting_doc, weight in postings:
+                    if last is None or posting_doc > last:
+                        encoded.extend((posting_doc - (last or 0), weight))
+                        last = posting_doc
+            self._write(path, existing)
+
+        for number, entries in docs.items():
+            path = f"docs/{number}.json"
+            existing = self._read(path, [])
+            for position, entry in entries:
+                existing.extend([None] * (position + 1 - len(existing)))
+                existing[position] = entry
+            self._write(path, existing)
+
+        added = doc - manifest["docs"]
+        manifest["docs"] = doc
+        manifest["shards"] = sorted(set(manifest["shards"]) | set(shards))
+        self._write("manifest.json", manifest)
+        print(f"--- Search index: added {added} posts, rewrote {len(shards)} of {len(manifest['shards'])} term shards ---")
+        metrics.count("search_docs_indexed", added)
+        metrics.count("search_shards_written", len(shards))
+        return added
+
+
+def update_search_index(history):
+    if SEARCH_INDEX_DIR:
+        with metrics.stage("search_index"):
+            SearchIndex(history, _output_path(SEARCH_INDEX_DIR)).update()
+
+
+def generate_feed_html(posts, history=None):
+    trending_topics, post_to_cluster_map = get_trending_topics(posts, history)
+    trending_html = trending_topics_html(trending_topics)
+
+    if RENDER_MODE == "client":
+        with metrics.stage("render"):
+            write_client_feed(posts, trending_html, post_to_cluster_map)
+        return
+
+    pages = _paginate(posts)
+    for page_number, (start, page_posts) in enumerate(pages, 1):
+        if len(pages) > 1:
+            summary = f"Displaying posts {start + 1}-{start + len(page_posts)} of the {len(posts)} most recent posts."
+            pager_html = _pager_html(page_number, len(pages))
+        else:
+            summary = f"Displaying the {len(posts)} most recent posts."
+            pager_html = ""
+
+        with metrics.stage("render"), open(_output_path(_page_filename(page_number)), "w", encoding="utf-8") as f:
+            f.write(feed_html_head(trending_html, summary))
+            f.write(pager_html)
+            for i, post in enumerate(page_posts, start):
+                f.write(fragment_cache.get(post, post_to_cluster_map.get(i)))
+            f.write(pager_html)
+            f.write(FEED_HTML_TAIL)
+        metrics.count("render_bytes", os.path.getsize(_output_path(_page_filename(page_number))))
+
+    _remove_stale_pages(len(pages))
+    print(f"--- Reused {fragment_cache.hits} cached posts, rendered {fragment_cache.misses} ---")
+    metrics.count("fragments_reused", fragment_cache.hits)
+    metrics.count("fragments_rendered", fragment_cache.misses)
+    fragment_cache.prune()
+    print(f"--- {len(pages)} page(s) of HTML generated successfully! ---")
+
+
+def next_headline(candidates):
+    if TEST_HEADLINE:
+        print(f"Using test headline: \"{TEST_HEADLINE}\"")
+        return {'title': TEST_HEADLINE, 'link': '#', 'body': '#', 'image_object': None}
+    return get_headline(candidates)
+
+
+def release_headlines(candidates, headlines):
+    # Put headlines whose generation failed back at the front of the queue for the next run
+    if TEST_HEADLINE:
+        return
+    for post_data in headlines:
+        candidates.release(post_data["link"])
+
+
+def make_post(post_data, comment_section, update_time_utc):
+    return {
+        "timestamp": update_time_utc,
+        "headline": {
+            "title": post_data['title'],
+            "body": post_data['body'],
+            "link": post_data['link']
+        },
+        "comments": comment_section
+    }
+
+
+def generate_post(candidates):
+    personas = load_personas()
+    print("\n--- Starting New Post Generation ---")
+    update_time_utc = datetime.now(timezone.utc).strftime("%B %d, %Y at %H:%M UTC")
+
+    post_data = next_headline(candidates)
+
+    if not post_data:
+        print("\n--- Skipped all generation due to failure in fetching a headline. ---")
+        return None
+
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            initial_history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        initial_history = []
+        comment_section = generate_reddit_comments(
+            post_data["title"],
+            post_data["body"],
+            post_data.get("image_object"),
+            personas
+        )
+    except Exception as e:
+        print(f"\n--- Comment generation for \"{post_data['title']}\" failed: {e} ---")
+        comment_section = None
+    if not comment_section:
+        print("\n--- Skipped post due to failure in comment generation. ---")
+        release_headlines(candidates, [post_data])
+        return None
 
-    posts_to_render = initial_history[:MAX_POSTS_TO_DISPLAY]
-    generate_feed_html(posts_to_render, initial_history)
+    return make_post(post_data, comment_section, update_time_utc)
 
-    completed_posts = 0
-    while completed_posts < NUMBER_OF_NEW_POSTS:
-        personas = load_personas()
-        print("\n--- Starting New Post Generation ---")
-        update_time_utc = datetime.now(timezone.utc).strftime("%B %d, %Y at %H:%M UTC")
 
+# Several headlines in one request with one persona draw; each post that got a readable comment
+# section is returned, the rest are skipped like a failed single generation.
+def generate_batch(candidates, size):
+    if size == 1:
+        return [generate_post(candidates)]
+    personas = load_personas()
+    print(f"\n--- Starting Batch of {size} Posts ---")
+    update_time_utc = datetime.now(timezone.utc).strftime("%B %d, %Y at %H:%M UTC")
+
+    headlines = []
+    while len(headlines) < size:
+        post_data = next_headline(candidates)
+        if not post_data:
+            break
+        headlines.append(post_data)
+    if not headlines:
+        print("\n--- Skipped all generation due to failure in fetching a headline. ---")
+        return []
+
+    try:
+        sections = generate_batch_comments(
+            [(post_data["title"], post_data["body"], post_data.get("image_object")) for post_data in headlines],
+            personas)
+    except Exception as e:
+        print(f"\n--- Comment generation for a batch of {len(headlines)} posts failed: {e} ---")
+        release_headlines(candidates, headlines)
+        return []
+
+    posts = []
+    for post_data, comment_section in zip(headlines, sections):
+        if comment_section:
+            posts.append(make_post(post_data, comment_section, update_time_utc))
+        else:
+            print(f"--- Skipped \"{post_data['title']}\" due to failure in comment generation. ---")
+            release_headlines(candidates, [post_data])
+    return posts
+
+
+# Generations run GENERATION_CONCURRENCY at a time behind the shared rate limiter; history is only
+# written and the page only rendered once every result is in.
+def generate_new_posts(candidates, count):
+    batch_size = max(1, BATCH_SIZE)
+    batch_sizes = [min(batch_size, count - start) for start in range(0, count, batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, GENERATION_CONCURRENCY)) as pool:
+        results = list(pool.map(lambda size: generate_batch(candidates, size), batch_sizes))
+
+    new_posts = [post for batch in results for post in batch if post]
+    metrics.count("posts_generated", len(new_posts))
+    metrics.count("posts_failed", count - len(new_posts))
+    print(f"\n--- Generated {len(new_posts)} of {count} posts ---")
+    return new_posts
+
+
+def persist_posts(new_posts):
+    with metrics.stage("history_update"):
+        for post in new_posts:
+            update_post_history(post)
+            # Only now is the headline safe to drop from the queue
+            if not TEST_HEADLINE:
+                get_candidate_queue().complete(post["headline"]["link"])
+
+
+def generate_posts(candidates, count):
+    new_posts = generate_new_posts(candidates, count)
+    persist_posts(new_posts)
+    return new_posts
+
+
+def render_feed():
+    post_history = get_post_history()
+    generate_feed_html(post_history.latest(MAX_POSTS_TO_DISPLAY), post_history)
+    update_search_index(post_history)
+
+
+def report_metrics():
+    print("\n--- Run metrics ---")
+    print(metrics.summary())
+    print(f"--- Metrics written to {metrics.write()} ---")
+
+
+# Resident mode: one process posts every SERVICE_INTERVAL seconds, so torch, the embedding model, the
+# HTTP pool, personas and the history indexes are loaded once instead of on every run. Ticks are
+# aligned to multiples of the interval like a cron schedule. Each tick is a chain of harvest ->
+# generate -> persist -> render jobs on a single worker; a tick that comes due while the last one is
+# still running is skipped. SIGINT/SIGTERM stop scheduling and let queued jobs finish, a second
+# signal exits straight away.
+class Service:
+    def __init__(self, interval=SERVICE_INTERVAL, posts_per_tick=SERVICE_POSTS_PER_TICK, max_ticks=0):
+        self.interval = interval
+        self.posts_per_tick = posts_per_tick
+        self.max_ticks = max_ticks
+        self.jobs = queue.Queue()
+        self.stopping = threading.Event()
+        self.ticks = 0
+
+    def warm_up(self):
+        started = time.perf_counter()
+        get_embedding_model()
+        get_http_session()
+        load_personas()
+        get_seen_links()
+        get_candidate_queue()
+        get_headline_index()
+        get_topic_index()
+        print(f"--- Loaded shared resources in {time.perf_counter() - started:.2f}s ---")
+
+    def _next_tick(self):
+        return (time.time() // self.interval + 1) * self.interval
+
+    def _run_jobs(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                name, fn, args = job
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"\n--- {name} job failed: {e} ---")
+            finally:
+                self.jobs.task_done()
+
+    def _enqueue(self, name, fn, *args):
+        self.jobs.put((name, fn, args))
+
+    def _harvest(self, tick):
+        global YOUTH_SLANG
+        metrics.reset()
+        print(f"\n--- Tick {tick} at {datetime.now(timezone.utc).strftime('%H:%M:%S UTC')} ---")
+        YOUTH_SLANG = choose_slang()
+        if not TEST_HEADLINE:
+            # Nothing is in flight between ticks, so claims still held belong to a tick that failed
+            get_candidate_queue().release_claims()
         if TEST_HEADLINE:
-            post_data = {'title': TEST_HEADLINE, 'link': '#', 'body': '#', 'image_object': None}
-            print(f"Using test headline: \"{TEST_HEADLINE}\"")
+            candidates = []
+        elif LLM_CACHE_MODE == "replay":
+            candidates = get_candidate_queue()
         else:
-            post_data = get_headline(random.choice(RSS_FEEDS))
-
-        if post_data:
-            comment_section = generate_reddit_comments(
-                post_data["title"],
-                post_data["body"],
-                post_data.get("image_object")
-            )
-            if comment_section:
-                new_post_data = {
-                    "timestamp": update_time_utc,
-                    "headline": {
-                        "title": post_data['title'],
-                        "body": post_data['body'],
-                        "link": post_data['link']
-                    },
-                    "comments": comment_section
-                }
+            candidates = harvest_candidates(RSS_FEEDS)
+        # Only the first tick starts from a snapshot, so a replay follows later ticks only while they harvest nothing new
+        if LLM_CACHE_MODE == "record" and tick == 1:
+            save_llm_state()
+        self._enqueue("generate", self._generate, candidates)
+
+    def _generate(self, candidates):
+        new_posts = generate_new_posts(candidates, self.posts_per_tick)
+        if new_posts:
+            self._enqueue("persist", self._persist, new_posts)
+        else:
+            report_metrics()
+
+    def _persist(self, new_posts):
+        persist_posts(new_posts)
+        self._enqueue("render", self._render)
+
+    def _render(self):
+        render_feed()
+        report_metrics()
+
+    def stop(self, signum=None, frame=None):
+        if signum is not None:
+            print(f"\n--- Received signal {signum}, finishing queued jobs before exiting ---")
+            signal.signal(signum, signal.SIG_DFL)
+        self.stopping.set()
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.stop)
+        self.warm_up()
+        worker = threading.Thread(target=self._run_jobs, name="service-jobs")
+        worker.start()
+        try:
+            while not self.stopping.is_set() and (not self.max_ticks or self.ticks < self.max_ticks):
+                if self.ticks and self.interval > 0:
+                    due = self._next_tick()
+                    print(f"\n--- Next tick at {datetime.fromtimestamp(due, timezone.utc).strftime('%H:%M:%S UTC')} ---")
+                    if self.stopping.wait(max(0.0, due - time.time())):
+                        break
+                if self.jobs.unfinished_tasks:
+                    print("\n--- Previous tick is still running, skipping this one ---")
+                    continue
+                self.ticks += 1
+                self._enqueue("harvest", self._harvest, self.ticks)
+                if self.interval <= 0:
+                    self.jobs.join()
+        finally:
+            # Jobs enqueue their follow-up before they are marked done, so this waits for whole ticks
+            self.jobs.join()
+            self.jobs.put(None)
+            worker.join()
+        print(f"\n--- Service stopped after {self.ticks} ticks ---")
 
-                full_history = update_post_history(new_post_data)
-                posts_to_render = full_history[:MAX_POSTS_TO_DISPLAY]
-                generate_feed_html(posts_to_render, full_history)
+
+if __name__ == "__main__":
+    import_time = time.perf_counter() - _IMPORT_STARTED
+    print(f"--- main.py imported in {import_time:.2f}s (budget {IMPORT_TIME_BUDGET:.2f}s) ---")
+    if import_time > IMPORT_TIME_BUDGET:
+        print("Warning: import time is over budget, check for heavy module-level imports or setup.")
+
+    parser = argparse.ArgumentParser(description="Generate simulated comment sections and render the feed.")
+    parser.add_argument("--render-only", action="store_true",
+                        help="Rebuild the HTML from the post history without fetching feeds or calling Gemini.")
+    parser.add_argument("--harvest-only", action="store_true",
+                        help=f"Fetch the feeds into the candidate queue ({CANDIDATE_QUEUE_DB}) without generating anything.")
+    parser.add_argument("--no-harvest", action="store_true",
+                        help="Generate from the already queued candidates without fetching any feeds.")
+    parser.add_argument("--serve", action="store_true",
+                        help="Stay resident and post on a schedule, reusing the loaded models and caches between ticks.")
+    parser.add_argument("--interval", type=int, default=SERVICE_INTERVAL,
+                        help="Seconds between --serve ticks, aligned to the clock; 0 runs the ticks back to back.")
+    parser.add_argument("--posts-per-tick", type=int, default=SERVICE_POSTS_PER_TICK)
+    parser.add_argument("--ticks", type=int, default=0, help="Stop --serve after this many ticks, 0 runs until signalled.")
+    parser.add_argument("--render-mode", choices=["static", "client"], default=RENDER_MODE,
+                        help=f"static pre-renders every post into the HTML, client writes a small page that renders "
+                             f"posts from {CLIENT_DATA_DIR}/ as they scroll into view.")
+    parser.add_argument("--llm-cache", choices=["off", "record", "replay"], default=LLM_CACHE_MODE,
+                        help=f"Gemini response cache in {LLM_CACHE_DIR}/: record reuses and saves responses along "
+                             "with the post history and candidate queue, replay only answers from it, never calls "
+                             "Gemini, posts from a copy of the recorded queue instead of fetching the feeds and renders "
+                             f"into {LLM_CACHE_DIR}/replay/ instead of the live feed.")
+    parser.add_argument("--embedding-backend", choices=sorted(EMBEDDING_BACKENDS), default=EMBEDDING_BACKEND,
+                        help="Headline embeddings for topics and repost detection. hashing needs no model download "
+                             "and works offline; switching rebuilds the embedding caches.")
+    parser.add_argument("--embedding-batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--embedding-threads", type=int, default=EMBEDDING_THREADS,
+                        help="Torch CPU threads for the sentence-transformers backend, 0 keeps the default.")
+    parser.add_argument("--seed", type=int,
+                        help="Seed the slang, persona and headline choices so a replay sends the same prompts.")
+    parser.add_argument("--profile", action="append", default=[], metavar="STAGE",
+                        help="Run this stage under cProfile, e.g. gemini, feed_parse, topics, render. Repeatable.")
+    parser.add_argument("--trace-memory", action="append", default=[], metavar="STAGE",
+                        help="Report tracemalloc peak and top allocations for this stage. Repeatable.")
+    args = parser.parse_args()
+    LLM_CACHE_MODE = args.llm_cache
+    RENDER_MODE = args.render_mode
+    EMBEDDING_BACKEND = args.embedding_backend
+    EMBEDDING_BATCH_SIZE = args.embedding_batch_size
+    EMBEDDING_THREADS = args.embedding_threads
+    if args.seed is not None:
+        random.seed(args.seed)
+        YOUTH_SLANG = choose_slang()
+        GENERATION_CONCURRENCY = 1  # Threads would draw from the seeded generator in whatever order they run
+    metrics.profile_stages.update(args.profile)
+    metrics.trace_stages.update(args.trace_memory)
+    if LLM_CACHE_MODE == "replay":
+        use_llm_state()
+
+    if args.serve:
+        Service(args.interval, args.posts_per_tick, args.ticks).run()
+    elif args.harvest_only:
+        harvest_candidates(RSS_FEEDS)
+        report_metrics()
+    else:
+        if not args.render_only:
+            if TEST_HEADLINE:
+                candidates = []
+            elif args.no_harvest or LLM_CACHE_MODE == "replay":
+                candidates = get_candidate_queue()
             else:
-                print("\n--- Skipped HTML generation due to failure in comment generation. ---")
-        else:
-            print("\n--- Skipped all generation due to failure in fetching a headline. ---")
+                candidates = harvest_candidates(RSS_FEEDS)
+            if LLM_CACHE_MODE == "record":
+                save_llm_state()
+            generate_posts(candidates, NUMBER_OF_NEW_POSTS)
 
-        completed_posts += 1
-        if completed_posts < NUMBER_OF_NEW_POSTS:
-            time.sleep(2)
+        render_feed()
+        report_metrics()
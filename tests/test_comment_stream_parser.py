@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from main import CommentStreamParser, repair_and_parse_json
+
+
+COMMENTS = [
+    {"author": "/u/first", "comment": "Top level", "upvotes": 12, "replies": [
+        {"author": "/u/second", "comment": "A reply", "upvotes": 3, "replies": [
+            {"author": "/u/third", "comment": "Deeper", "upvotes": 1, "replies": []}
+        ]}
+    ]},
+    {"author": "/u/braces", "comment": "Closing early: }] and opening {[ inside a string", "upvotes": 5, "replies": []},
+    {"author": "/u/quotes", "comment": "He said \"}\" and left \\ behind", "upvotes": -2, "replies": []},
+]
+
+
+def chunks(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64, 10000])
+def test_chunked_stream_yields_each_comment_as_soon_as_it_closes(size):
+    parts = [json.dumps(comment) for comment in COMMENTS]
+    text = "[" + ", ".join(parts) + "]"
+    ends = [len("[" + ", ".join(parts[:i + 1])) for i in range(len(parts))]
+    parser = CommentStreamParser()
+    seen = []
+    received = 0
+    for chunk in chunks(text, size):
+        seen.extend(parser.feed(chunk))
+        received += len(chunk)
+        assert len(seen) == sum(end <= received for end in ends)
+    assert seen == COMMENTS
+    assert parser.result() == COMMENTS
+
+
+def test_braces_and_escaped_quotes_inside_strings():
+    parser = CommentStreamParser()
+    parser.feed(json.dumps(COMMENTS[1:]))
+    assert parser.result() == COMMENTS[1:]
+
+
+def test_code_fence_around_the_list():
+    text = "```json\n" + json.dumps(COMMENTS, indent=2) + "\n```"
+    parser = CommentStreamParser()
+    for chunk in chunks(text, 5):
+        parser.feed(chunk)
+    assert parser.result() == COMMENTS
+    assert repair_and_parse_json(text) == COMMENTS
+
+
+def test_salvages_completed_replies_of_a_cut_off_comment():
+    text = (
+        '[{"author": "a", "comment": "one", "upvotes": 1, "replies": []},'
+        ' {"author": "b", "comment": "two", "upvotes": 2, "replies": ['
+        '{"author": "c", "comment": "three", "upvotes": 3, "replies": []},'
+        ' {"author": "d", "comm'
+    )
+    parser = CommentStreamParser()
+    assert parser.feed(text) == [{"author": "a", "comment": "one", "upvotes": 1, "replies": []}]
+    assert parser.result() == [
+        {"author": "a", "comment": "one", "upvotes": 1, "replies": []},
+        {"author": "b", "comment": "two", "upvotes": 2, "replies": [
+            {"author": "c", "comment": "three", "upvotes": 3, "replies": []}
+        ]},
+    ]
+
+
+def test_drops_a_cut_off_comment_that_never_got_its_text():
+    parser = CommentStreamParser()
+    parser.feed('[{"author": "a", "comment": "one", "upvotes": 1, "replies": []}, {"author": "b", "comment": "tw')
+    assert parser.result() == [{"author": "a", "comment": "one", "upvotes": 1, "replies": []}]
+
+
+def test_truncated_response_is_salvaged_by_repair():
+    text = json.dumps(COMMENTS)
+    cut = text[:text.index('"Closing early') + len('"Closing early')]
+    assert repair_and_parse_json(cut) == [COMMENTS[0]]
+
+
+def test_cut_inside_an_escaped_quote_keeps_the_comments_before_it():
+    text = json.dumps(COMMENTS)
+    cut = text[:text.index('\\"}') + 3]  # stops right after the brace inside the quoted text
+    parser = CommentStreamParser()
+    parser.feed(cut)
+    assert parser.result() == COMMENTS[:2]
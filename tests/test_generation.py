@@ -0,0 +1,75 @@
+import json
+import shutil
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class StubClient:
+    def __init__(self, rate_limited_calls=1):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.rate_limited = 0
+        self.rate_limited_calls = rate_limited_calls
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def generate_content(self, contents, generation_config, stream=False):
+        with self.lock:
+            self.calls += 1
+            if self.rate_limited < self.rate_limited_calls:
+                self.rate_limited += 1
+                raise RateLimited("429 Resource has been exhausted")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Long enough for the other workers to get their requests in
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        text = json.dumps([{"author": "/u/stub", "comment": "First", "upvotes": 3, "replies": [
+            {"author": "/u/other", "comment": "Reply", "upvotes": 1, "replies": []}]}])
+        chunks = [Chunk(text[:20]), Chunk(text[20:])]
+        return iter(chunks) if stream else Chunk(text)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    shutil.copy(main.PERSONAS_FILE, tmp_path / "personas.yml")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "_resources", {})
+    monkeypatch.setattr(main, "TEST_HEADLINE", "Stubbed headline")
+    monkeypatch.setattr(main, "EMBEDDING_BACKEND", "hashing")
+    monkeypatch.setattr(main, "GENERATION_CONCURRENCY", 3)
+    monkeypatch.setattr(main, "BATCH_SIZE", 1)
+    monkeypatch.setattr(main, "GEMINI_BACKOFF_BASE", 0)
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(1000, 10 ** 9))
+    client = StubClient()
+    monkeypatch.setattr(main, "get_client", lambda: client)
+    return client
+
+
+def test_concurrent_generation_retries_429_and_only_persist_writes_history(pipeline):
+    new_posts = main.generate_new_posts([], 4)
+
+    assert len(new_posts) == 4
+    assert all(post["comments"][0].text == "First" for post in new_posts)
+    assert pipeline.rate_limited == 1
+    assert pipeline.calls == 5
+    assert pipeline.max_in_flight > 1
+    assert len(main.get_post_history()) == 0
+
+    main.persist_posts(new_posts)
+    assert len(main.get_post_history()) == 4
@@ -0,0 +1,56 @@
+from main import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_limiter(requests_per_minute, tokens_per_minute):
+    clock = FakeClock()
+    return RateLimiter(requests_per_minute, tokens_per_minute, clock=clock, sleep=clock.sleep), clock
+
+
+def test_full_bucket_allows_a_burst_then_waits_for_one_request():
+    limiter, clock = make_limiter(3, 100000)
+    for _ in range(3):
+        limiter.acquire(10)
+    assert clock.sleeps == []
+    limiter.acquire(10)
+    assert clock.sleeps == [20.0]
+
+
+def test_token_limit_waits_until_enough_tokens_refilled():
+    limiter, clock = make_limiter(100, 600)
+    limiter.acquire(600)
+    limiter.acquire(300)
+    assert clock.sleeps == [30.0]
+    assert clock.now == 30.0
+
+
+def test_request_larger_than_the_bucket_is_capped_to_it():
+    limiter, clock = make_limiter(100, 600)
+    limiter.acquire(10000)
+    assert clock.sleeps == []
+    limiter.acquire(10000)
+    assert clock.sleeps == [60.0]
+
+
+def test_idle_time_refills_only_up_to_capacity():
+    limiter, clock = make_limiter(3, 100000)
+    for _ in range(3):
+        limiter.acquire(1)
+    clock.now += 3600
+    for _ in range(3):
+        limiter.acquire(1)
+    assert clock.sleeps == []
+    limiter.acquire(1)
+    assert clock.sleeps == [20.0]